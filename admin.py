@@ -1,6 +1,7 @@
-from flask import Blueprint, abort, render_template, request
+from flask import Blueprint, abort, flash, redirect, render_template, request, url_for
 from flask_login import current_user
 from flask_wtf import FlaskForm
+from sqlalchemy.orm import joinedload
 from time import time
 from wtforms import fields, validators
 from werkzeug.security import gen_salt
@@ -47,15 +48,36 @@ def only_admins():
 @admin.route('/')
 def index():
     authors = Blogger.query.limit(24)
-    posts = CommitPost.query.order_by(CommitPost.datetime.desc()).limit(24)
-    waiting_tasks = Task.query.filter(Task.started.is_(None)).order_by(Task.created.desc()).limit(24)
+    posts = CommitPost.query \
+        .options(joinedload(CommitPost.repo), joinedload(CommitPost.blogger)) \
+        .order_by(CommitPost.datetime.desc()) \
+        .limit(24)
+    fallback_posts = CommitPost.query \
+        .options(joinedload(CommitPost.repo), joinedload(CommitPost.blogger)) \
+        .filter(CommitPost.render_fallback.isnot(None)) \
+        .order_by(CommitPost.id.desc()) \
+        .limit(24)
+    waiting_tasks = Task.query.filter(Task.started.is_(None) & Task.failed.is_(None)).order_by(Task.created.desc()).limit(24)
+    failed_tasks = Task.query.filter(Task.failed != None).order_by(Task.failed.desc()).limit(24)
     active_tasks = Task.query.filter((Task.started != None) & Task.completed.is_(None)).order_by(Task.started.desc()).limit(24)
     completed_tasks = Task.query.filter(Task.completed != None).order_by(Task.completed.desc()).limit(24)
     return render_template('admin/index.html',
-        authors=authors, posts=posts, waiting_tasks=waiting_tasks,
+        authors=authors, posts=posts, fallback_posts=fallback_posts,
+        waiting_tasks=waiting_tasks, failed_tasks=failed_tasks,
         active_tasks=active_tasks, completed_tasks=completed_tasks)
 
 
+@admin.route('/tasks/<int:task_id>/requeue', methods=('POST',))
+def requeue_task(task_id):
+    task = Task.query.get(task_id) or abort(404)
+    if task.failed is None:
+        abort(400, 'only failed tasks can be requeued')
+    task.requeue()
+    db.session.commit()
+    flash(f'Requeued task {task.task} ({task.id})', 'info')
+    return redirect(url_for('admin.index'))
+
+
 @admin.route('/clients', methods=('GET', 'POST'))
 def clients():
     form = ClientAddForm(request.form)
@@ -2,8 +2,10 @@ from authlib.integrations.flask_oauth2 import current_token
 from flask import Blueprint, abort, request, session, url_for
 from sqlalchemy.exc import IntegrityError
 from oauth import require_oauth
+import feeds
 from known_git_hosts import github
 from models import db, CommitPost, Repo, Task
+from pagecache import page_cache
 
 api = Blueprint('api', __name__)
 
@@ -27,14 +29,15 @@ def post_blog(sha):
     db.session.add(commit)
     if repo_created:
         db.session.add(repo)
-        db.session.add(Task(
-            task='clone',
-            details={'full_name': repo.full_name},
-            creator=blogger))
+        Task.enqueue('clone', {'full_name': repo.full_name}, creator=blogger)
     try:
+        db.session.flush()
+        feeds.refresh(blogger)
+        blogger.touch_blog()
         db.session.commit()
     except IntegrityError:
         return 'seems like it\'s already blogged!', 400
+    page_cache.invalidate(blogger.username)
 
     post_url = url_for('blog.commit_post', _external=True,
         blogger=blogger.username, repo_name=repo.full_name, hex=sha)
@@ -53,7 +56,7 @@ def unpost_blog(sha):
     else:
         return 'only github ssh origin is supported for now', 400
 
-    commit = CommitPost.query.filter(
+    commit = CommitPost.query.join(CommitPost.repo).filter(
         CommitPost.hex==sha, Repo.full_name==repo).first()
     if commit is None:
         return 'could not find that post -- maybe it\'s already deleted?', 404
@@ -62,6 +65,10 @@ def unpost_blog(sha):
         return 'can only unpost your own posts', 403
 
     db.session.delete(commit)
+    db.session.flush()
+    feeds.refresh(blogger)
+    blogger.touch_blog()
     db.session.commit()
+    page_cache.invalidate(blogger.username)
 
     return '', 204
@@ -0,0 +1,105 @@
+"""Generated commit messages for the render benchmarks
+
+Every message is built from a seeded random.Random, so a corpus is the same
+from run to run and results can be compared.
+"""
+
+import random
+
+
+WORDS = '''
+the a to of and in is it for on that this with from be fix add remove make
+update refactor test tests build config parser render renderer cache feed
+blog post commit message page query index user repo token session request
+response handler worker task queue retry timeout error bug typo readme docs
+faster slower instead because when now still only again first last every
+'''.split()
+
+LANGUAGES = ['python', 'js', 'sql', 'bash', 'diff', 'rust', 'html', '', 'nonsense']
+
+CODE_LINES = [
+    'def frobnicate(thing, *, eager=False):',
+    '    return [x.frob() for x in thing if x is not None]',
+    'const answer = await fetch(`/api/${id}`).then(r => r.json());',
+    'SELECT id, title FROM commit_post WHERE blogger_id = 4 ORDER BY datetime DESC;',
+    '- old_line = "removed"',
+    '+ new_line = "added"',
+    'for f in *.md; do pandoc "$f" -o "${f%.md}.html"; done',
+    'fn main() { println!("{}", 40 + 2); }',
+    '<div class="post" data-id="12">&amp; &lt;escaped&gt;</div>',
+]
+
+
+def sentence(rng, words=None):
+    words = [rng.choice(WORDS) for _ in range(words or rng.randint(5, 16))]
+    return ' '.join(words).capitalize() + '.'
+
+
+def paragraph(rng, sentences=None):
+    return ' '.join(sentence(rng) for _ in range(sentences or rng.randint(2, 6)))
+
+
+def title(rng):
+    return sentence(rng, rng.randint(3, 8))[:-1]
+
+
+def short(rng):
+    return title(rng)
+
+
+def long_prose(rng):
+    return '\n\n'.join([title(rng)] + [paragraph(rng) for _ in range(rng.randint(8, 20))])
+
+
+def code_fences(rng):
+    parts = [title(rng), paragraph(rng)]
+    for _ in range(rng.randint(3, 8)):
+        lines = [rng.choice(CODE_LINES) for _ in range(rng.randint(3, 30))]
+        parts.append(f'```{rng.choice(LANGUAGES)}\n' + '\n'.join(lines) + '\n```')
+        parts.append(sentence(rng))
+    return '\n\n'.join(parts)
+
+
+def links_and_images(rng):
+    parts = [title(rng)]
+    for i in range(rng.randint(5, 15)):
+        parts.append(rng.choice([
+            f'See [the docs](https://example.com/docs/{i}) and https://example.com/{i}?a=1&b=2.',
+            f'Fixes #{i}, thanks @someone{i} for www.example.org/{i}.',
+            f'![screenshot {i}](screenshots/{i}.png) and ![abs](https://example.com/{i}.png)',
+            f'Relative readme.md and mailto:dev{i}@example.com, not links. {sentence(rng)}',
+            f'<https://example.com/auto/{i}> and <b>raw html</b> <script>no({i})</script>',
+        ]))
+    return '\n\n'.join(parts)
+
+
+def footnotes(rng):
+    count = rng.randint(3, 12)
+    body = ' '.join(f'{sentence(rng)}[^{n}]' for n in range(count))
+    notes = '\n'.join(f'[^{n}]: {sentence(rng)}' for n in range(count))
+    return f'{title(rng)}\n\n{body}\n\n{notes}'
+
+
+def pathological(rng):
+    depth = rng.randint(10, 30)
+    nested_list = '\n'.join('    ' * d + f'- {sentence(rng, 3)}' for d in range(depth))
+    nested_quote = '\n'.join('> ' * d + sentence(rng, 3) for d in range(1, depth))
+    emphasis = '*' * depth + ' '.join(['_under_ **strong**'] * depth) + '*' * (depth - 1)
+    brackets = '[' * depth + 'link' + ']' * depth + '(' * depth + ')' * (depth - 1)
+    return '\n\n'.join([title(rng), nested_list, nested_quote, emphasis, brackets])
+
+
+KINDS = {
+    'short': short,
+    'long prose': long_prose,
+    'code fences': code_fences,
+    'links and images': links_and_images,
+    'footnotes': footnotes,
+    'pathological': pathological,
+}
+
+
+def generate(per_kind=50, seed=0):
+    """{kind: [message, ...]}"""
+    rng = random.Random(seed)
+    return {kind: [make(rng) for _ in range(per_kind)] for kind, make in KINDS.items()}
@@ -0,0 +1,58 @@
+"""Compare a fresh Markdown instance per render against the pooled instances
+
+    python -m benchmarks.markdown_pool
+"""
+
+import markdown
+from timeit import repeat
+import render_message
+
+
+MESSAGES = {}
+
+MESSAGES['short'] = '''\
+Fix a typo in the readme, thanks @rileyjshaw
+'''
+
+MESSAGES['with code'] = '''\
+Make the frobnicator less eager
+
+The frobnicator used to run on every request, see #123 and @uniphil's
+notes in the [design doc](https://example.com/doc). Now it only runs when
+asked[^1].
+
+```python
+def frobnicate(thing):
+    return thing.frob()
+```
+
+- it's faster
+- it's quieter
+
+[^1]: mostly.
+'''
+
+
+def fresh(message):
+    gh_links = render_message.GithubLinksAlsoImages(
+        user='uniphil', repo='commit--blog', sha='asdf')
+    extensions = render_message.get_base_extensions() + (gh_links,)
+    return markdown.markdown(message, extensions=extensions)
+
+
+def pooled(message):
+    with render_message.markdown_pool.markdown('uniphil', 'commit--blog', 'asdf') as md:
+        return md.convert(message)
+
+
+def main(number=200):
+    for label, message in MESSAGES.items():
+        assert fresh(message) == pooled(message)
+        print(f'{label} message:')
+        for name, fn in (('fresh instance', fresh), ('pooled instance', pooled)):
+            best = min(repeat(lambda: fn(message), number=number, repeat=5)) / number
+            print(f'  {name:>16}: {best * 1e6:8.1f} µs per render')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Render pipeline benchmarks over a generated commit message corpus
+
+    python -m benchmarks.render [--out results.json] [--compare old.json]
+
+For each kind of message in benchmarks.corpus, reports the best of a few
+runs for each stage of render_github (in µs per message), end-to-end
+throughput, and peak memory traced while rendering. Results are written as
+JSON, and --compare prints the change from an earlier results file, e.g.
+one saved before bumping Markdown, bleach or Pygments.
+
+render_github cleans and linkifies in a single pass ("clean + linkify");
+"clean" and "linkify" time the two as separate bleach passes, to show
+where that time goes.
+"""
+
+import argparse
+import bleach
+import json
+import markdown
+import platform
+import pygments
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+import render_message
+from benchmarks import corpus
+
+
+USER, REPO, SHA = 'uniphil', 'commit--blog', 'b7caf89bfd8f67e459e8e86e684553f99533c495'
+
+
+def timed(fn, totals, label):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            totals[label] += time.perf_counter() - start
+    return wrapper
+
+
+def time_stages(messages):
+    """seconds spent in each stage, rendering every message once"""
+    totals = defaultdict(float)
+    md = render_message.markdown_pool.build()
+    md.gh_links.set_commit(USER, REPO, SHA)
+    for processor in md.treeprocessors:
+        label = f'treeprocessor {type(processor).__name__}'
+        processor.run = timed(processor.run, totals, label)
+    sanitiser = bleach.Cleaner(render_message.markdown_tags, render_message.allowed_attrs)
+    linker = bleach.Linker(callbacks=[render_message.only_abs_link], skip_tags=['code'])
+    cleaner = render_message.get_cleaner()
+
+    for message in messages:
+        start = time.perf_counter()
+        html = md.convert(message)
+        totals['markdown'] += time.perf_counter() - start
+        md.reset()
+
+        start = time.perf_counter()
+        clean = sanitiser.clean(html)
+        totals['clean'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        linker.linkify(clean)
+        totals['linkify'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        cleaner.clean(html)
+        totals['clean + linkify'] += time.perf_counter() - start
+
+    tree = sum(t for label, t in totals.items() if label.startswith('treeprocessor'))
+    totals['markdown'] -= tree
+    return totals
+
+
+def render_all(messages):
+    for message in messages:
+        render_message.render_github_uncached(message, USER, REPO, SHA)
+
+
+def bench_kind(messages, repeat):
+    render_all(messages)  # warm up: imports, lexers, pooled instances
+    stages = {}
+    for _ in range(repeat):
+        for label, seconds in time_stages(messages).items():
+            stages[label] = min(seconds, stages.get(label, seconds))
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render_all(messages)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    render_all(messages)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    size = sum(len(m.encode()) for m in messages)
+    return {
+        'messages': len(messages),
+        'bytes': size,
+        'stages_us': {label: seconds / len(messages) * 1e6
+                      for label, seconds in sorted(stages.items())},
+        'total_us': best / len(messages) * 1e6,
+        'messages_per_s': len(messages) / best,
+        'kb_per_s': size / 1024 / best,
+        'peak_memory_kb': peak / 1024,
+    }
+
+
+def run(per_kind, repeat, seed):
+    results = {
+        'date': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'versions': {
+            'renderer': render_message.__version__,
+            'markdown': markdown.__version__,
+            'bleach': bleach.__version__,
+            'pygments': pygments.__version__,
+        },
+        'corpus': {'per_kind': per_kind, 'seed': seed},
+        'kinds': {},
+    }
+    for kind, messages in corpus.generate(per_kind, seed).items():
+        results['kinds'][kind] = bench_kind(messages, repeat)
+    return results
+
+
+def report(results, baseline=None):
+    def change(new, old):
+        return f' ({(new - old) / old:+.0%})' if old else ''
+
+    print(', '.join(f'{k} {v}' for k, v in results['versions'].items()))
+    for kind, result in results['kinds'].items():
+        old = (baseline or {}).get('kinds', {}).get(kind, {})
+        print(f'\n{kind} ({result["messages"]} messages, {result["bytes"]} bytes):')
+        for label, us in result['stages_us'].items():
+            print(f'  {label:>40}: {us:9.1f} µs{change(us, old.get("stages_us", {}).get(label))}')
+        for key, unit in (('total_us', 'µs/message'), ('messages_per_s', 'messages/s'),
+                          ('kb_per_s', 'KB/s'), ('peak_memory_kb', 'KB peak')):
+            print(f'  {key:>40}: {result[key]:9.1f} {unit}{change(result[key], old.get(key))}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--per-kind', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='render-benchmark.json')
+    parser.add_argument('--compare', help='an earlier results file to compare against')
+    args = parser.parse_args()
+
+    results = run(args.per_kind, args.repeat, args.seed)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nsaved to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Compare clean-then-linkify (two html parses) against the single-pass Cleaner
+
+    python -m benchmarks.sanitise
+"""
+
+import bleach
+from timeit import repeat
+import render_message
+
+
+PARAGRAPH = '''\
+Teach the importer about www.example.com/feeds and https://example.com/a?b=c
+so links like <https://example.com/x> & plain `https://example.com/code`
+survive, mention @uniphil and fix #12 while we're at it. See the notes in
+[the doc](https://example.com/doc "title") and ![a diagram](diagram.png).
+
+```python
+url = "https://example.com/in/code"  # not a link
+```
+
+- www.example.org is a list item
+- so is readme.md, which isn't a link[^{n}]
+
+[^{n}]: footnote {n}, from mailto:someone@example.com
+'''
+
+MESSAGES = {
+    'short': PARAGRAPH.format(n=1),
+    'long': '\n'.join(PARAGRAPH.format(n=n) for n in range(40)),
+}
+
+
+def two_pass(html):
+    safe = bleach.clean(html, render_message.markdown_tags, render_message.allowed_attrs)
+    return bleach.linkify(safe, callbacks=[render_message.only_abs_link], skip_tags=['code'])
+
+
+def single_pass(html):
+    return render_message.get_cleaner().clean(html)
+
+
+def main(number=20):
+    for label, message in MESSAGES.items():
+        with render_message.markdown_pool.markdown('uniphil', 'commit--blog', 'asdf') as md:
+            html = md.convert(message)
+        assert two_pass(html) == single_pass(html)
+        print(f'{label} message ({len(html)} chars of html):')
+        for name, fn in (('two passes', two_pass), ('single pass', single_pass)):
+            best = min(repeat(lambda: fn(html), number=number, repeat=5)) / number
+            print(f'  {name:>12}: {best * 1e3:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,137 @@
-from feedwerk.atom import AtomFeed
-from flask import Blueprint, abort, render_template, request, url_for
-from models import Blogger, CommitPost, Repo
+from flask import (
+    Blueprint, Response, abort, current_app, redirect,
+    render_template, request, session, stream_with_context, url_for)
+from flask_login import current_user
+from functools import wraps
+from hashlib import sha1
+from werkzeug.http import is_resource_modified
+import feeds
+from models import db, Blogger, CommitPost, Task
+from pagecache import page_cache
+from paging import Page, StreamedPage, get_page
 
 
 blog = Blueprint('blog', __name__)
 
 
+def get_validators(blogger):
+    """ETag for a blogger's pages, as seen by the current visitor"""
+    version = '|'.join(map(str, (
+        blogger.blog_version, page_cache.app_version,
+        blogger.username, blogger.name, current_user.get_id())))
+    return sha1(version.encode()).hexdigest()
+
+
+def stream_template(template_name, after=None, **context):
+    """Render a template in pieces as its content is generated
+
+    Each piece goes out as soon as it's ready, so the page header reaches the
+    client before the posts have been queried. `after` is called once the
+    last piece is out, still in the request context.
+    """
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    def generate():
+        yield from template.generate(context)
+        if after is not None:
+            after()
+    return stream_with_context(generate())
+
+
+def read_repair(posts):
+    """Queue rerenders for stale posts that are being shown
+
+    Posts on an old renderer converge on the current one as they're read,
+    without waiting for their owner. Posts that already have a rerender
+    queued are skipped, as are ones waiting on their first render.
+
+    Call it after rendering: committing expires everything the session has
+    loaded, so it only commits when something was queued.
+    """
+    if not current_app.config['READ_REPAIR']:
+        return
+    stale = {post.id: post for post in posts
+             if post.can_rerender() and post.render_fallback != 'pending'}
+    if not stale:
+        return
+    post_id = Task.details['post_id'].as_integer()
+    queued = Task.query \
+        .filter(Task.task == 'rerender') \
+        .filter(Task.completed.is_(None)) \
+        .filter(post_id.in_(stale)) \
+        .with_entities(post_id)
+    missing = stale.keys() - {id for id, in queued}
+    for id in missing:
+        Task.enqueue('rerender', {'post_id': id}, priority=Task.BACKGROUND,
+                     creator=stale[id].blogger)
+    if missing:
+        db.session.commit()
+
+
+def conditional(view):
+    """Resolve the blogger and answer conditional GETs before rendering
+
+    The wrapped view gets the Blogger instead of the subdomain string.
+    Anonymous visitors get pages from the page cache when they're still
+    current for the ETag.
+    """
+    @wraps(view)
+    def wrapper(blogger, **kwargs):
+        blog_author = Blogger.from_subdomain(blogger) or abort(404)
+        if '_flashes' in session:
+            # flashed messages are shown once, so this render can't be reused
+            return view(blog_author, **kwargs)
+
+        etag = get_validators(blog_author)
+        if is_resource_modified(request.environ, etag):
+            response = page_cache.serve(blog_author.username, etag,
+                                        lambda: view(blog_author, **kwargs))
+        else:
+            response = Response(status=304)
+        response.set_etag(etag)
+        response.vary.add('Cookie')
+        return response
+    return wrapper
+
+
 @blog.route('/')
+@conditional
 def list(blogger):
-    blog_author = Blogger.from_subdomain(blogger) or abort(404)
-    posts = CommitPost.query \
-                .filter_by(blogger=blog_author) \
-                .order_by(CommitPost.datetime.desc())
-    return render_template('blog-list.html', posts=posts, blogger=blog_author)
+    before, after = request.args.get('before'), request.args.get('after')
+    if current_app.config['STREAM_BLOG_LIST'] and after is None:
+        page = StreamedPage(blogger, before=before,
+            per_page=current_app.config['STREAM_POSTS_PER_PAGE'],
+            batch_size=current_app.config['STREAM_BATCH_SIZE'])
+        return Response(stream_template('blog-list.html', page=page, blogger=blogger,
+            after=lambda: read_repair(page.served)))
+    page = Page(*get_page(blogger, before=before, after=after))
+    html = render_template('blog-list.html', page=page, blogger=blogger)
+    read_repair(page)
+    return html
 
 
 @blog.route('/feed')
+@conditional
 def feed(blogger):
-    blog_author = Blogger.from_subdomain(blogger) or abort(404)
-    posts = CommitPost.query \
-                .filter_by(blogger=blog_author) \
-                .order_by(CommitPost.datetime.desc())
-    feed = AtomFeed('$ commits-by ' + (blog_author.name or blog_author.username),
-                    feed_url=request.url, url=request.url_root)
-    for post in posts:
-        feed.add(
-            post.get_title(),
-            post.get_body(markdown=True),
-            content_type='html',
-            author=blog_author.name or blog_author.username,
-            url=url_for('blog.commit_post', _external=True,
-                        blogger=blog_author.username,
-                        repo_name=post.repo.full_name,
-                        hex=post.hex),
-            updated=post.datetime,
-            published=post.datetime,
-        )
-    return feed.get_response()
+    before, after = request.args.get('before'), request.args.get('after')
+    if before is None and after is None:
+        entries, updated, older = feeds.get_head(blogger)
+        newer = None
+    else:
+        posts, newer, older = get_page(blogger, before=before, after=after,
+            per_page=current_app.config['FEED_MAX_ENTRIES'])
+        entries = [feeds.serialize_entry(post, blogger) for post in posts]
+        updated = posts[0].datetime if posts else None
+    return feeds.get_response(blogger, entries, updated, newer, older)
 
 
 @blog.route('/<path:repo_name>/<hex>')
+@conditional
 def commit_post(blogger, repo_name, hex):
-    blog_author = Blogger.from_subdomain(blogger) or abort(404)
-    repo = Repo.query.filter_by(full_name=repo_name).first() or abort(404)
-    post = CommitPost.query \
-                .filter_by(blogger=blog_author, repo=repo, hex=hex) \
-                .first() or abort(404)
-    return render_template('blog-post.html', post=post, blogger=blog_author)
+    post = CommitPost.from_permalink(blogger, repo_name, hex) or abort(404)
+    if post.hex != hex:
+        return redirect(url_for('blog.commit_post', blogger=blogger.username,
+                                repo_name=repo_name, hex=post.hex), 301)
+    html = render_template('blog-post.html', post=post, blogger=blogger)
+    read_repair([post])
+    return html
@@ -0,0 +1,103 @@
+"""Rerender every post that's stale for the current renderer, resumably"""
+
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy.orm import joinedload
+import json
+import logging
+import os
+import time
+import feeds
+import render_message
+from models import db, Blogger, CommitPost
+from pagecache import page_cache
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return 0
+    if checkpoint['renderer'] != render_message.__version__:
+        logging.info('checkpoint is for another renderer version, starting over')
+        return 0
+    return checkpoint['last_id']
+
+
+def write_checkpoint(path, last_id):
+    with open(path, 'w') as f:
+        json.dump({'renderer': render_message.__version__, 'last_id': last_id}, f)
+
+
+def render(job):
+    """(post id, html, fallback reason or None), within the render guard's limits"""
+    post_id, body, full_name, sha = job
+    if not body:
+        return post_id, '', None
+    user, repo_name = full_name.split('/', 1)
+    return (post_id, *render_message.render_guard.render(body, user, repo_name, sha))
+
+
+def render_all(threads, jobs):
+    rendered = {post_id: result for post_id, *result in threads.map(render, jobs)}
+    # a timeout kills the guard's pool along with the other renders on it, so
+    # give timed-out ones another go, one at a time
+    retry = [job for job in jobs if rendered[job[0]][1] == 'timed out']
+    rendered.update((post_id, result) for post_id, *result in map(render, retry))
+    return rendered
+
+
+def rerender_stale(processes=None, batch_size=200, checkpoint='.rerender-checkpoint'):
+    last_id = read_checkpoint(checkpoint)
+    total = CommitPost.stale_renders().filter(CommitPost.id > last_id).count()
+    logging.info(f'{total} stale posts to rerender, starting after id {last_id}')
+
+    workers = processes or os.cpu_count()
+    config = current_app.config
+    render_message.render_guard.configure(
+        config['RENDER_MAX_BYTES'], config['RENDER_TIMEOUT'], workers)
+    threads = ThreadPoolExecutor(workers)
+    done, started = 0, time.monotonic()
+    try:
+        while True:
+            batch = CommitPost.stale_renders() \
+                .options(joinedload(CommitPost.repo)) \
+                .filter(CommitPost.id > last_id) \
+                .order_by(CommitPost.id) \
+                .limit(batch_size) \
+                .all()
+            if not batch:
+                break
+
+            jobs = [(post.id, post.get_body(), post.repo.full_name, post.hex)
+                    for post in batch]
+            rendered = render_all(threads, jobs)
+            for post in batch:
+                post.markdown_body, post.render_fallback = rendered[post.id]
+                post.markdown_renderer = render_message.__version__
+
+            blogger_ids = {post.blogger_id for post in batch}
+            for blogger in Blogger.query.filter(Blogger.id.in_(blogger_ids)):
+                feeds.invalidate(blogger)
+                blogger.touch_blog()
+            db.session.commit()
+            for blogger in Blogger.query.filter(Blogger.id.in_(blogger_ids)):
+                page_cache.invalidate(blogger.username)
+
+            last_id = batch[-1].id
+            write_checkpoint(checkpoint, last_id)
+            done += len(batch)
+            elapsed = time.monotonic() - started
+            rate = done / elapsed if elapsed else 0
+            eta = (total - done) / rate if rate else 0
+            logging.info(f'rerendered {done}/{total} ({rate:.1f} posts/s, '
+                         f'~{eta:.0f}s left), up to id {last_id}')
+    finally:
+        threads.shutdown()
+        render_message.render_guard.close()
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    logging.info(f'done: rerendered {done} posts in {time.monotonic() - started:.1f}s')
+    return done
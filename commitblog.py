@@ -10,6 +10,7 @@
 """
 
 from os import environ
+import difflib
 from datetime import datetime
 from flask import (
     Flask, Blueprint, request, flash, session,
@@ -17,6 +18,7 @@ from flask import (
 from flask_login import (
     LoginManager, current_user, login_required, login_user, logout_user)
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from wtforms import fields, validators
 from flask_wtf import Form
 from secrets import compare_digest
@@ -26,7 +28,12 @@ from blog import blog
 from admin import admin
 from oauth import oauth, SCOPES
 from emails import mail
+import feeds
+from pagecache import page_cache
 import limits
+import querycount
+import render_message
+from wakeup import task_wakeup
 from models import (
     db, message_parts, AnonymousUser,
     Blogger, Email, Repo, CommitPost, Task)
@@ -94,10 +101,17 @@ def dashboard():
                 title, body = message_parts(commit['message'])
                 if not body:
                     continue
-                post = CommitPost.query.filter_by(hex=commit['sha']).first()
-                commit.update(title=title, body=body, post=post)
+                commit.update(title=title, body=body)
                 commit_events.append(commit)
 
+    # look up every already-blogged commit in one go
+    posts = CommitPost.query \
+        .options(joinedload(CommitPost.repo)) \
+        .filter(CommitPost.hex.in_([c['sha'] for c in commit_events]))
+    posts_by_hex = {post.hex: post for post in posts}
+    for commit in commit_events:
+        commit.update(post=posts_by_hex.get(commit['sha']))
+
     email = current_user.get_email(True)
     auth_tokens = OAuth2Token.query.filter(
         (OAuth2Token.blogger == current_user) &
@@ -118,17 +132,22 @@ def add_post():
         db.session.add(commit)
         if repo_created:
             db.session.add(repo)
-            db.session.add(Task(task='clone', details={'full_name': repo.full_name}))
+            Task.enqueue('clone', {'full_name': repo.full_name})
         try:
+            db.session.flush()
+            feeds.refresh(current_user)
+            current_user.touch_blog()
             db.session.commit()
         except IntegrityError:
             flash('Already blogged!', 'info')
+        else:
+            page_cache.invalidate(current_user.username)
         return redirect(url_for('account.dashboard'))
 
     return render_template('blog-add.html', form=form)
 
 
-def get_confirmation_email_task(email):
+def queue_confirmation_email(email):
     previous_confirmation_sends = Task.query \
         .filter(Task.task == 'email') \
         .filter(Task.creator == current_user) \
@@ -136,7 +155,7 @@ def get_confirmation_email_task(email):
         .filter(Task.details['message'].as_string() == 'confirm_email')
     if previous_confirmation_sends.count() >= limits.EMAIL_CONFIRMATION_SENDS:
         abort(429, f'Max {limits.EMAIL_CONFIRMATION_SENDS} confirmation email sends. Get in touch if you haven\'t received any!')
-    return Task(task='email', details={
+    return Task.enqueue('email', {
         'recipient': email.address,
         'message': 'confirm_email',
         'variables': {
@@ -144,7 +163,7 @@ def get_confirmation_email_task(email):
             'confirm_url': url_for('account.confirm_email', _external=True,
                 address=email.address, token=email.token),
         },
-    })
+    }, priority=Task.URGENT)
 
 
 @account.route('/account/add-gh-email', methods=('POST',))
@@ -168,7 +187,7 @@ def add_gh_email():
             db.session.commit()
         except IntegrityError:
             abort(401, 'This email address may already be in use')
-        db.session.add(get_confirmation_email_task(email))
+        queue_confirmation_email(email)
         db.session.commit()
         flash(f'Email added! Confirmation email will be sent to {address}', 'info')
     else:
@@ -189,7 +208,7 @@ def add_email():
             db.session.commit()
         except IntegrityError:
             abort(401, 'This email address may already be in use')
-        db.session.add(get_confirmation_email_task(email))
+        queue_confirmation_email(email)
         db.session.commit()
         flash(f'Email added! Confirmation email will be sent to {address}', 'info')
         return redirect(url_for('account.dashboard'))
@@ -204,7 +223,7 @@ def resend_confirmation_email(address):
         .filter(Email.address == address) \
         .filter(Email.blogger == current_user) \
         .first_or_404()
-    db.session.add(get_confirmation_email_task(email))
+    queue_confirmation_email(email)
     db.session.commit()
     flash(f'Confirmation email resent to {address}', 'info')
     return redirect(url_for('account.dashboard'))
@@ -250,7 +269,10 @@ def name_edit():
         new_name, old_name = form.display_name.data, current_user.name
         current_user.name = new_name
         db.session.add(current_user)
+        feeds.invalidate(current_user)
+        current_user.touch_blog()
         db.session.commit()
+        page_cache.invalidate(current_user.username)
         flash('Display name updated: {} ➔ {}'.format(
             old_name, new_name), 'info')
         return redirect(url_for('account.dashboard'))
@@ -262,13 +284,14 @@ def name_edit():
 @login_required
 def remove_post(repo_name, hex):
     form = UnpostForm(request.form)
-    repo = Repo.query.filter_by(full_name=repo_name).first() or abort(404)
-    commit = CommitPost.query \
-                .filter_by(blogger=current_user, hex=hex, repo=repo) \
-                .first() or abort(404)
+    commit = CommitPost.from_permalink(current_user, repo_name, hex) or abort(404)
     if request.method == 'POST' and form.validate():
         db.session.delete(commit)
+        db.session.flush()
+        feeds.refresh(current_user)
+        current_user.touch_blog()
         db.session.commit()
+        page_cache.invalidate(current_user.username)
         flash(f'Unposted commit: {commit.repo.full_name}/{commit.hex[:8]} ➔ 💨', 'info')
         return redirect(url_for('blog.list', blogger=current_user.username))
     return render_template('blog-unpost.html', post=commit, form=form)
@@ -277,15 +300,16 @@ def remove_post(repo_name, hex):
 @account.route('/<path:repo_name>/<hex>/rerender', methods=('GET', 'POST'))
 @login_required
 def rerender_preview(repo_name, hex):
-    repo = Repo.query.filter_by(full_name=repo_name).first() or abort(404)
-    commit = CommitPost.query \
-                .filter_by(blogger=current_user, hex=hex, repo=repo) \
-                .first() or abort(404)
+    commit = CommitPost.from_permalink(current_user, repo_name, hex) or abort(404)
 
     if request.method == 'POST':
         commit.apply_rerender()
         db.session.add(commit)
+        db.session.flush()
+        feeds.refresh(current_user, changed=[commit.id])
+        current_user.touch_blog()
         db.session.commit()
+        page_cache.invalidate(current_user.username)
         flash('✓ Applied new renderer', 'info')
         next = request.args.get('next') \
             or url_for('blog.commit_post', _external=True,
@@ -300,11 +324,6 @@ def rerender_preview(repo_name, hex):
         preview = commit.get_rerender_preview()
         if preview is None:
             noop_message = f'Commit rerender appears to be empty :/'
-        elif preview == commit.markdown_body:
-            noop_message = f'No change detected for this commit with the new render config'
-            commit.apply_rerender()
-            db.session.add(commit)
-            db.session.commit()
     else:
         noop_message = f'Commit seems to already be rendered with the latest renderer'
 
@@ -315,7 +334,43 @@ def rerender_preview(repo_name, hex):
             or url_for('blog.list', blogger=current_user.username)
         return redirect(next)
 
-    return render_template('rerender-preview.html', post=commit, preview=preview)
+    return render_template('rerender-preview.html', post=commit, preview=preview,
+        unchanged=preview == commit.markdown_body)
+
+
+@account.route('/account/rerender', methods=('GET', 'POST'))
+@login_required
+def rerender_batch():
+    if request.method == 'POST':
+        ids = request.form.getlist('post', type=int)
+        posts = CommitPost.stale_renders() \
+            .options(joinedload(CommitPost.repo)) \
+            .filter(CommitPost.blogger_id == current_user.id) \
+            .filter(CommitPost.id.in_(ids)) \
+            .all()
+        for post in posts:
+            post.apply_rerender()
+        db.session.flush()
+        feeds.refresh(current_user, changed=[post.id for post in posts])
+        current_user.touch_blog()
+        db.session.commit()
+        page_cache.invalidate(current_user.username)
+        flash(f'✓ Applied new renderer to {len(posts)} posts', 'info')
+        return redirect(url_for('account.rerender_batch'))
+
+    stale = CommitPost.stale_renders() \
+        .options(joinedload(CommitPost.repo)) \
+        .filter(CommitPost.blogger_id == current_user.id)
+    posts = stale.order_by(CommitPost.id).limit(limits.RERENDER_BATCH_SIZE).all()
+    previews = []
+    for post in posts:
+        preview = post.get_rerender_preview() or ''
+        diff = difflib.unified_diff(
+            (post.markdown_body or '').splitlines(), preview.splitlines(),
+            'previous render', 'new render', lineterm='')
+        previews.append((post, '\n'.join(diff)))
+    return render_template('rerender-batch.html',
+        previews=previews, remaining=stale.count() - len(posts))
 
 
 @account.route('/account/oauth/revoke', methods=('POST', ))
@@ -361,6 +416,7 @@ def configure(app, config):
         SQLALCHEMY_DATABASE_URI = get('DATABASE_URL', 'sqlite:///db'),
         SQLALCHEMY_TRACK_MODIFICATIONS = False,
         TESTING                 = bool(get('TESTING', False)),
+        QUERY_COUNT_HEADER      = bool(get('QUERY_COUNT_HEADER', get('TESTING', False))),
         GITHUB_CLIENT_ID        = get('GITHUB_CLIENT_ID'),
         GITHUB_CLIENT_SECRET    = get('GITHUB_CLIENT_SECRET'),
         CSRF_ENABLED            = get('CSRF_ENABLED', True),  # testing ONLY
@@ -370,6 +426,24 @@ def configure(app, config):
         MAIL_USE_TLS            = get('MAIL_USE_TLS') != 'False',
         MAIL_USERNAME           = get('MAIL_USERNAME'),
         MAIL_PASSWORD           = get('MAIL_PASSWORD'),
+        FEED_MAX_ENTRIES        = int(get('FEED_MAX_ENTRIES', 20)),
+        STREAM_BLOG_LIST        = get('STREAM_BLOG_LIST') == 'True',
+        STREAM_POSTS_PER_PAGE   = int(get('STREAM_POSTS_PER_PAGE', 200)),
+        STREAM_BATCH_SIZE       = int(get('STREAM_BATCH_SIZE', 20)),
+        PAGE_CACHE_BACKEND      = get('PAGE_CACHE_BACKEND', 'lru'),
+        PAGE_CACHE_SIZE         = int(get('PAGE_CACHE_SIZE', 512)),
+        PAGE_CACHE_DIR          = get('PAGE_CACHE_DIR', './page-cache'),
+        PAGE_CACHE_BLOG_PAGES   = int(get('PAGE_CACHE_BLOG_PAGES', 64)),
+        RENDER_CACHE_SIZE       = int(get('RENDER_CACHE_SIZE', 1024)),
+        RENDER_CACHE_DIR        = get('RENDER_CACHE_DIR'),
+        RENDER_MAX_BYTES        = int(get('RENDER_MAX_BYTES', 64 * 1024)),
+        RENDER_TIMEOUT          = float(get('RENDER_TIMEOUT', 10)),
+        RENDER_WORKERS          = int(get('RENDER_WORKERS', 2)),
+        RENDER_ASYNC            = get('RENDER_ASYNC') == 'True',
+        READ_REPAIR             = get('READ_REPAIR', 'True') == 'True',
+        TASK_WAKEUP             = get('TASK_WAKEUP', 'auto'),
+        TASK_WAKEUP_DIR         = get('TASK_WAKEUP_DIR', './task-wakeup'),
+        TASK_POLL_INTERVAL      = float(get('TASK_POLL_INTERVAL', 30)),
         USE_SESSION_FOR_NEXT    = True,
     )
     app.config['AUTHLIB_INSECURE_TRANSPORT'] = app.debug
@@ -399,6 +473,13 @@ def create_app(config=None):
     db.init_app(app)
     login_manager.init_app(app)
     mail.init_app(app)
+    page_cache.init_app(app)
+    render_message.render_cache.configure(
+        app.config['RENDER_CACHE_SIZE'], app.config['RENDER_CACHE_DIR'])
+    render_message.render_guard.configure(app.config['RENDER_MAX_BYTES'],
+        app.config['RENDER_TIMEOUT'], app.config['RENDER_WORKERS'])
+    querycount.init_app(app)
+    task_wakeup.init_app(app)
     csrf.exempt(api)
     app.register_blueprint(api, url_prefix='/api')
     app.register_blueprint(pages)
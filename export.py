@@ -0,0 +1,138 @@
+"""Render blogs to a static directory tree that nginx can serve
+
+For each blogger:
+
+    <out>/<username>/index.html                 first page of blog.list
+    <out>/<username>/feed.xml                   first page of blog.feed
+    <out>/<username>/<repo>/<sha>/index.html    blog.commit_post
+
+Pages come from the app's own views through a test client, so they match
+what Flask would serve. Older list and feed pages (`?before=...`) aren't
+exported: requests with a query string should fall through to Flask.
+
+A manifest in the output directory remembers each blog's validator, the
+app version it was exported with, and a fingerprint per post page, so an incremental export skips unchanged blogs,
+rewrites only the post pages that changed, and deletes pages for unposted
+commits and deleted accounts. A new app version (templates or renderer)
+rewrites everything.
+"""
+
+from flask import current_app, url_for
+from hashlib import sha1
+from multiprocessing import Pool
+from sqlalchemy.orm import joinedload
+import json
+import logging
+import os
+import shutil
+from blog import get_validators
+from models import Blogger, CommitPost
+from pagecache import page_cache
+import util
+from util import write_atomic
+
+
+MANIFEST = '.export-manifest.json'
+
+
+def load_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def post_fingerprint(post, blogger):
+    parts = (post.message, post.markdown_body, post.markdown_renderer,
+             blogger.name, blogger.username)
+    return sha1('\0'.join(map(str, parts)).encode()).hexdigest()
+
+
+def export_blogger(out_dir, blogger_id, previous=None):
+    """Export one blog, returning its new manifest entry
+
+    With the `previous` manifest entry, only what changed since is written.
+    """
+    app = current_app._get_current_object()
+    blogger = Blogger.query.get(blogger_id)
+    blog_dir = os.path.join(out_dir, blogger.username_lower)
+    client = app.test_client()
+
+    def fetch(endpoint, **kwargs):
+        with app.test_request_context():
+            url = url_for(endpoint, _external=True, blogger=blogger.username, **kwargs)
+        resp = client.get(url)
+        if resp.status_code != 200:
+            raise RuntimeError(f'got {resp.status_code} exporting {url}')
+        return resp.get_data()
+
+    with app.test_request_context():
+        validator = get_validators(blogger)
+        app_version = page_cache.app_version
+    if previous is not None and previous.get('app_version') != app_version:
+        previous = dict(previous, validator=None, posts={
+            page: None for page in previous['posts']})  # rewrite every page
+    if previous is not None and previous['validator'] == validator:
+        return previous
+
+    write_atomic(os.path.join(blog_dir, 'index.html'), fetch('blog.list'))
+    write_atomic(os.path.join(blog_dir, 'feed.xml'), fetch('blog.feed'))
+
+    previous_posts = previous['posts'] if previous is not None else {}
+    posts = {}
+    blog_posts = CommitPost.query \
+        .options(joinedload(CommitPost.repo)) \
+        .filter(CommitPost.blogger_id == blogger.id)
+    for post in blog_posts:
+        page = os.path.join(post.repo.full_name, post.hex, 'index.html')
+        fingerprint = post_fingerprint(post, blogger)
+        if previous_posts.get(page) != fingerprint:
+            write_atomic(os.path.join(blog_dir, page), fetch(
+                'blog.commit_post', repo_name=post.repo.full_name, hex=post.hex))
+        posts[page] = fingerprint
+
+    for page in previous_posts.keys() - posts.keys():
+        try:
+            os.remove(os.path.join(blog_dir, page))
+            os.removedirs(os.path.dirname(os.path.join(blog_dir, page)))
+        except OSError:
+            pass  # already gone, or the repo dir still has other posts
+
+    logging.info(f'exported {blogger.username}')
+    return {'validator': validator, 'app_version': app_version, 'posts': posts}
+
+
+def _export_in_worker(job):
+    out_dir, blogger_id, previous = job
+    with util.worker_app.app_context():
+        return blogger_id, export_blogger(out_dir, blogger_id, previous)
+
+
+def export(out_dir, incremental=False, processes=1):
+    """Export every blog, in `processes` worker processes"""
+    manifest = load_manifest(out_dir) if incremental else {}
+    bloggers = Blogger.query.with_entities(Blogger.id, Blogger.username_lower)
+    previous_by_id = {}
+    usernames = {}
+    for blogger_id, username in bloggers:
+        usernames[blogger_id] = username
+        previous_by_id[blogger_id] = manifest.get(username)
+
+    jobs = [(out_dir, blogger_id, previous)
+            for blogger_id, previous in previous_by_id.items()]
+    if processes > 1:
+        with Pool(processes, initializer=util.init_worker) as pool:
+            results = pool.imap_unordered(_export_in_worker, jobs)
+            exported = dict(results)
+    else:
+        exported = {blogger_id: export_blogger(out_dir, blogger_id, previous)
+                    for out_dir, blogger_id, previous in jobs}
+
+    new_manifest = {usernames[blogger_id]: entry
+                    for blogger_id, entry in exported.items()}
+    for username in manifest.keys() - new_manifest.keys():
+        shutil.rmtree(os.path.join(out_dir, username), ignore_errors=True)
+
+    write_atomic(os.path.join(out_dir, MANIFEST), json.dumps(new_manifest).encode())
+    return new_manifest
@@ -0,0 +1,111 @@
+"""Atom feeds for blogs
+
+A feed shows the blogger's newest FEED_MAX_ENTRIES posts, with RFC 5005
+paged-feed links (`next`, `previous`, `first`) for walking back through
+older ones.
+
+The entries on the first page are kept serialised in a BlogFeed row. Write
+paths call `refresh` when posts are added or removed, which serialises only
+the posts that are new to the feed. Changes that touch every entry, like a
+new display name, call `invalidate` so the next poll rebuilds it.
+"""
+
+from feedwerk.atom import AtomFeed, FeedEntry
+from flask import Response, current_app, request, url_for
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from models import db, BlogFeed, CommitPost
+from paging import make_cursor
+
+
+def feed_url(blogger, **kwargs):
+    return url_for('blog.feed', _external=True, blogger=blogger.username, **kwargs)
+
+
+def serialize_entry(post, blogger):
+    entry = FeedEntry(
+        post.get_title(),
+        post.get_body(markdown=True),
+        content_type='html',
+        author=blogger.name or blogger.username,
+        url=url_for('blog.commit_post', _external=True,
+                    blogger=blogger.username,
+                    repo_name=post.repo.full_name,
+                    hex=post.hex),
+        updated=post.datetime,
+        published=post.datetime,
+        feed_url=feed_url(blogger),
+    )
+    return ''.join('  ' + line for line in entry.generate())
+
+
+def refresh(blogger, changed=()):
+    """Bring the stored feed entries up to date with the blogger's posts
+
+    Only the newest posts' ids are queried; entries already serialised are
+    reused unless their post id is in `changed`. Call it after flushing the
+    add or remove, in the same transaction.
+    """
+    max_entries = current_app.config['FEED_MAX_ENTRIES']
+    head = db.session.query(CommitPost.id, CommitPost.datetime) \
+        .filter(CommitPost.blogger_id == blogger.id) \
+        .order_by(CommitPost.datetime.desc(), CommitPost.id.desc()) \
+        .limit(max_entries + 1) \
+        .all()
+    head, more = head[:max_entries], len(head) > max_entries
+
+    feed = blogger.feed or BlogFeed(blogger=blogger, entries=[])
+    known = {entry['id']: entry['xml'] for entry in feed.entries
+             if entry['id'] not in changed}
+    missing = [post_id for post_id, _ in head if post_id not in known]
+    if missing:
+        posts = CommitPost.query \
+            .options(joinedload(CommitPost.repo)) \
+            .filter(CommitPost.id.in_(missing))
+        known.update((post.id, serialize_entry(post, blogger)) for post in posts)
+
+    feed.entries = [{'id': post_id, 'xml': known[post_id]} for post_id, _ in head]
+    feed.updated = head[0].datetime if head else None
+    feed.older = make_cursor(head[-1]) if more else None
+    db.session.add(feed)
+    return feed
+
+
+def invalidate(blogger):
+    if blogger.feed is not None:
+        db.session.delete(blogger.feed)
+
+
+def is_current(feed):
+    """whether the stored entries were built for the current FEED_MAX_ENTRIES"""
+    max_entries = current_app.config['FEED_MAX_ENTRIES']
+    if feed.older is not None:  # there were more posts than fit
+        return len(feed.entries) == max_entries
+    return len(feed.entries) <= max_entries
+
+
+def get_head(blogger):
+    """The stored entries for the first page of the feed, built if needed"""
+    feed = blogger.feed
+    if feed is None or not is_current(feed):
+        try:
+            feed = refresh(blogger)
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent first poll stored it first; theirs is as good as ours
+            db.session.rollback()
+            feed = blogger.feed or refresh(blogger)
+    return [entry['xml'] for entry in feed.entries], feed.updated, feed.older
+
+
+def get_response(blogger, entries, updated, newer=None, older=None):
+    links = [{'rel': 'first', 'href': feed_url(blogger)}]
+    if newer is not None:
+        links.append({'rel': 'previous', 'href': feed_url(blogger, after=newer)})
+    if older is not None:
+        links.append({'rel': 'next', 'href': feed_url(blogger, before=older)})
+    feed = AtomFeed('$ commits-by ' + (blogger.name or blogger.username),
+                    feed_url=request.url, url=request.url_root,
+                    updated=updated, links=links)
+    *head, end = feed.generate()
+    return Response(''.join(head + entries + [end]), mimetype='application/atom+xml')
@@ -2,13 +2,14 @@ import dateutil.parser
 from flask import (
     Blueprint, redirect, request, session as client_session, url_for
 )
-from flask_login import login_required, login_user, logout_user
+from flask_login import current_user, login_required, login_user, logout_user
 from rauth.service import OAuth2Session, OAuth2Service
 from requests.sessions import Session
 from requests.utils import default_user_agent
 from urllib.parse import urlparse, urljoin
 
-from models import Blogger, CommitPost
+from models import db, Blogger, CommitPost
+from pagecache import page_cache
 
 
 gh = Blueprint('gh', __name__)
@@ -140,11 +141,13 @@ def authorized():
 @gh.route('/delete-account', methods=['POST'])
 @login_required
 def delete_account():
+    username = current_user.username
     for post in current_user.commit_posts:
         db.session.delete(post)
     db.session.delete(current_user)
     # don't delete repos because they may be used by other users
     # later maybe prune orphans
     db.session.commit()
+    page_cache.invalidate(username)
     logout_user()
     return redirect(url_for('pages.hello'))
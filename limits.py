@@ -1 +1,11 @@
 EMAIL_CONFIRMATION_SENDS = 3
+BLOG_POSTS_PER_PAGE = 20
+RERENDER_BATCH_SIZE = 20
+
+TASK_MAX_ATTEMPTS = {
+    'clone': 3,
+    'email': 6,
+}
+TASK_DEFAULT_MAX_ATTEMPTS = 3
+TASK_RETRY_DELAY = 30  # seconds, doubled for each attempt
+TASK_RETRY_MAX_DELAY = 60 * 60
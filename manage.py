@@ -23,6 +23,12 @@ except ImportError:
 manager = Manager(create_app)
 
 
+def log_progress():
+    """show the logging.info progress of long-running commands"""
+    import logging
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+
 @manager.command
 def init_db():
     from commitblog import db
@@ -87,14 +93,139 @@ def migrate(q):
         add column gh_email_choice boolean check
         (gh_email_choice in (0, 1))
         """)
+    migs['q4'] = text("""
+        create index ix_commit_post_blogger_datetime_id
+        on commit_post (blogger_id, datetime, id)
+        """)
+    migs['q5'] = text("""
+        alter table blogger
+        add column username_lower varchar(39)
+        """)
+    migs['q6'] = text("""
+        update blogger
+        set username_lower = lower(username)
+        """)
+    migs['q7'] = text("""
+        create unique index ix_blogger_username_lower
+        on blogger (username_lower)
+        """)
+    migs['q8'] = text("""
+        alter table commit_post
+        add column title varchar
+        """)
+    migs['q9'] = text("""
+        alter table commit_post
+        add column body varchar
+        """)
+    migs['q10'] = text("""
+        alter table commit_post
+        add column render_fallback varchar null
+        """)
+    migs['q11'] = text("""
+        alter table task
+        add column attempts integer not null default 0
+        """)
+    migs['q12'] = text("""
+        alter table task
+        add column run_after timestamp null
+        """)
+    migs['q13'] = text("""
+        alter table task
+        add column failed timestamp null
+        """)
+    migs['q14'] = text("""
+        alter table task
+        add column priority integer not null default 0
+        """)
+    migs['q15'] = text("""
+        create index ix_task_waiting_priority_created
+        on task (task, priority desc, created, id)
+        where started is null and failed is null
+        """)
+    migs['q16'] = text("""
+        alter table blogger
+        add column blog_version integer not null default 0
+        """)
     query = migs[q]
     db.engine.execute(query.execution_options(autocommit=True))
 
 
 @manager.command
-def run_tasks():
+def export_static(out_dir='./static-blogs', incremental=False, processes='1'):
+    """render every blog to static files for nginx to serve"""
+    import export
+    log_progress()
+    export.export(out_dir, incremental=incremental, processes=int(processes))
+
+
+@manager.command
+def backfill_message_parts(batch_size='500'):
+    """split titles and bodies out of posts from before migrations q8/q9"""
+    from commitblog import db, CommitPost
+    from models import message_parts
+    last_id = 0
+    while True:
+        posts = CommitPost.query \
+            .filter(CommitPost.id > last_id) \
+            .filter(CommitPost.title.is_(None)) \
+            .order_by(CommitPost.id) \
+            .limit(int(batch_size)) \
+            .all()
+        if not posts:
+            break
+        for post in posts:
+            post.title, post.body = message_parts(post.message)
+        db.session.commit()
+        last_id = posts[-1].id
+        print(f'backfilled posts up to id {last_id}')
+
+
+@manager.command
+def rerender(processes='0', batch_size='200', checkpoint='.rerender-checkpoint'):
+    """rerender posts from older renderers, resuming from the checkpoint"""
+    import bulk_rerender
+    log_progress()
+    bulk_rerender.rerender_stale(processes=int(processes) or None,
+        batch_size=int(batch_size), checkpoint=checkpoint)
+
+
+@manager.command
+def highlight_timings(limit='1000'):
+    """render recent posts and report how much of it was code highlighting"""
+    import time
+    import render_message
+    from commitblog import CommitPost
+    posts = CommitPost.query.order_by(CommitPost.id.desc()).limit(int(limit))
+    render_message.pygments_cache.timings.clear()
+    total = 0.0
+    for post in posts:
+        if text := post.get_body():
+            user, repo_name = post.repo.full_name.split('/', 1)
+            start = time.perf_counter()
+            render_message.render_github_uncached(text, user, repo_name, post.hex)
+            total += time.perf_counter() - start
+    timings = render_message.pygments_cache.timings
+    highlighting = sum(seconds for _, seconds in timings.values())
+    print(f'rendering: {total:.3f}s, highlighting: {highlighting:.3f}s'
+          f' ({highlighting / total if total else 0:.0%})')
+    for lexer, (blocks, seconds) in sorted(timings.items(), key=lambda t: -t[1][1]):
+        print(f'  {lexer:>20}: {blocks:5} blocks, {seconds * 1e3 / blocks:8.2f} ms each')
+
+
+@manager.command
+def run_tasks(task_type=None, concurrency='', processes=''):
+    """run queued tasks, eg. --concurrency=email=4,clone=2 --processes=rerender
+
+    Each task type runs up to its concurrency (default 1) at once, in
+    threads, or in worker processes for the types listed in --processes.
+    SIGTERM finishes the running tasks and exits.
+    """
     import tasks
-    tasks.run()
+    limits = {}
+    for limit in filter(None, concurrency.split(',')):
+        name, n = limit.split('=')
+        limits[name] = int(n)
+    tasks.run(task_type, limits=limits, processes=filter(None, processes.split(',')))
 
 
 @manager.command
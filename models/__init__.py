@@ -1,13 +1,18 @@
+from datetime import datetime
+from flask import current_app
 from flask_login import AnonymousUserMixin, UserMixin, current_user
 from flask_sqlalchemy import SQLAlchemy
 from secrets import randbelow, compare_digest
-from sqlalchemy import func
+from sqlalchemy import func, or_
+from sqlalchemy.orm import contains_eager, validates
 from uuid import uuid4
 import re
 import render_message
+from lru import LRUCache
 
 
 GH_RAW_BASE = 'https://raw.githubusercontent.com'
+SHORT_SHA = re.compile('[0-9a-f]{7,39}')
 
 
 db = SQLAlchemy()
@@ -36,10 +41,12 @@ class Blogger(db.Model, UserMixin):
     admin = db.Column(db.Boolean, nullable=False, default=lambda: False)
     gh_id = db.Column(db.String(32), unique=True)
     username = db.Column(db.String(39), unique=True)  # GH max is 39
+    username_lower = db.Column(db.String(39), unique=True, index=True)  # for subdomains
     name = db.Column(db.String(128))
     avatar_url = db.Column(db.String(256))
     access_token = db.Column(db.String(40))  # GH tokens seem to always be 40 chars
     gh_email_choice = db.Column(db.Boolean, nullable=True)
+    blog_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     @classmethod
     def gh_get_or_create(cls, session):
@@ -60,10 +67,19 @@ class Blogger(db.Model, UserMixin):
 
         return user, email_to_ask
 
+    @validates('username')
+    def set_username_lower(self, key, username):
+        self.username_lower = username.lower() if username is not None else None
+        return username
+
+    def touch_blog(self):
+        """Bump blog_version, in the same transaction as a change to the blog"""
+        self.blog_version = Blogger.blog_version + 1
+
     @classmethod
     def from_subdomain(cls, username):
         """Handle casing issues with domains"""
-        return cls.query.filter(username.lower() == func.lower(cls.username)).first()
+        return cls.query.filter(cls.username_lower == username.lower()).first()
 
     def get_user_id(self):
         """get user id for oauth2"""
@@ -121,14 +137,22 @@ class Repo(db.Model):
 
 class CommitPost(db.Model):
 
-    __table_args__ = (db.UniqueConstraint('hex', 'repo_id'),)
+    __table_args__ = (
+        db.UniqueConstraint('hex', 'repo_id'),
+        # serves keyset pagination of a blogger's posts, newest first
+        db.Index('ix_commit_post_blogger_datetime_id',
+                 'blogger_id', 'datetime', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     hex = db.Column(db.String(40))
     message = db.Column(db.String)
+    title = db.Column(db.String)  # message_parts(message), split on write
+    body = db.Column(db.String)
     markdown_body = db.Column(db.String, default=lambda: '')
     markdown_renderer = db.Column(
         db.String, nullable=True, default=lambda: render_message.__version__)
+    render_fallback = db.Column(db.String, nullable=True)  # why it's plain text
     datetime = db.Column(db.DateTime)
     repo_id = db.Column(db.Integer, db.ForeignKey('repo.id'))
     blogger_id = db.Column(db.Integer, db.ForeignKey('blogger.id'))
@@ -136,42 +160,127 @@ class CommitPost(db.Model):
     repo = db.relationship('Repo')
     blogger = db.relationship('Blogger', backref=db.backref('commit_posts'))
 
+    # (post id, sha, renderer version) -> render(), until applied. the sha
+    # guards against a deleted post's id being reused.
+    _rerender_previews = LRUCache(1024)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        if text := self.get_body():
-            user, repo_name = self.repo.full_name.split('/', 1)
-            html = render_message.render_github(text, user, repo_name, self.hex)
-            self.markdown_body = html
+        if not self.get_body():
+            return
+        if current_app.config.get('RENDER_ASYNC'):
+            self.render_later()
+        else:
+            self.markdown_body, self.render_fallback = self.render()
+
+    @classmethod
+    def from_permalink(cls, blogger, repo_name, hex):
+        """Find a blogger's post from its repo name and sha in one query
+
+        Abbreviated shas (7+ hex characters) are matched as a range over the
+        (hex, repo_id) index. Ambiguous abbreviations find nothing.
+        """
+        posts = cls.query \
+            .join(cls.repo) \
+            .options(contains_eager(cls.repo)) \
+            .filter(cls.blogger_id == blogger.id) \
+            .filter(Repo.full_name == repo_name)
+        if SHORT_SHA.fullmatch(prefix := hex.lower()):
+            # every sha starting with the prefix sorts before prefix + 'g'
+            posts = posts.filter(cls.hex >= prefix, cls.hex < prefix + 'g')
+        else:
+            posts = posts.filter(cls.hex == hex)
+        found = posts.limit(2).all()
+        return found[0] if len(found) == 1 else None
+
+    @classmethod
+    def stale_renders(cls):
+        """posts rendered with something other than the current renderer"""
+        return cls.query.filter(or_(
+            cls.markdown_renderer != render_message.__version__,
+            cls.markdown_renderer.is_(None)))
+
+    @validates('message')
+    def split_message(self, key, message):
+        self.title, self.body = message_parts(message) \
+            if message is not None else (None, None)
+        return message
 
     def get_title(self):
-        return message_parts(self.message)[0]
+        return self.title
 
     def get_body(self, markdown=False):
         if markdown:
             return self.markdown_body
         else:
-            return message_parts(self.message)[1]
+            return self.body
 
     def can_rerender(self):
         return self.markdown_renderer != render_message.__version__
 
-    def get_rerender_preview(self):
+    def render(self):
+        """(html, fallback reason or None), within the render guard's limits"""
         if text := self.get_body():
             user, repo_name = self.repo.full_name.split('/', 1)
-            return render_message.render_github(text, user, repo_name, self.hex)
+            return render_message.render_guard.render(text, user, repo_name, self.hex)
+
+    def render_later(self):
+        """show the message as plain text, and queue a task to render it
+
+        Pending posts are on no renderer, so they count as changed (for page
+        validators) once the task renders them.
+        """
+        self.markdown_body = render_message.render_fallback(self.get_body())
+        self.markdown_renderer = db.null()  # plain None would get the default
+        self.render_fallback = 'pending'
+        return Task.enqueue('render', {'full_name': self.repo.full_name, 'hex': self.hex},
+                            priority=Task.URGENT, creator=self.blogger)
+
+    def render_preview(self):
+        """render(), remembered until applied or the renderer changes
+
+        Fallbacks (eg. a render that timed out) aren't remembered, so
+        applying tries the render again instead of keeping the fallback.
+        """
+        key = (self.id, self.hex, render_message.__version__)
+        if (rendered := self._rerender_previews.get(key)) is None:
+            rendered = self.render()
+            if rendered is not None and rendered[1] is None and self.id is not None:
+                self._rerender_previews.set(key, rendered)
+        return rendered
+
+    def get_rerender_preview(self):
+        if rendered := self.render_preview():
+            return rendered[0]
 
     def apply_rerender(self):
-        html = self.get_rerender_preview()
-        if html is None:
-            raise ValueError('rerender failed-- no content')
-        self.markdown_body = html
+        # posts without a body have nothing to render, but are still current
+        rendered = self.render_preview() or ('', None)
+        self.markdown_body, self.render_fallback = rendered
         self.markdown_renderer = render_message.__version__
+        self._rerender_previews.pop((self.id, self.hex, render_message.__version__))
 
     def __repr__(self):
         return '<CommitPost: {}...>'.format(self.message[:16])
 
 
+class BlogFeed(db.Model):
+    """Pre-serialised Atom entries for the newest posts in a blogger's feed"""
+    blogger_id = db.Column(db.Integer, db.ForeignKey('blogger.id'), primary_key=True)
+    entries = db.Column(db.JSON, nullable=False)  # [{id, xml}], newest first
+    updated = db.Column(db.DateTime, nullable=True)
+    older = db.Column(db.String, nullable=True)  # cursor for the next page
+
+    blogger = db.relationship('Blogger', backref=db.backref(
+        'feed', uselist=False, cascade='all, delete-orphan'))
+
+
 class Task(db.Model):
+    # higher priorities run first; ties go to the oldest task
+    URGENT = 10  # someone is waiting on it, like a confirmation email
+    NORMAL = 0
+    BACKGROUND = -10  # housekeeping, like rerenders from read repair
+
     id = db.Column(db.Integer, primary_key=True)
     task = db.Column(db.Text, nullable=False, index=True)
     details = db.Column(db.JSON, nullable=False)  # blob o' json
@@ -179,9 +288,46 @@ class Task(db.Model):
     started = db.Column(db.DateTime, nullable=True, index=True)
     completed = db.Column(db.DateTime, nullable=True, index=True)
     creator_id = db.Column(db.Integer, db.ForeignKey('blogger.id'), default=lambda: current_user.id)
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    run_after = db.Column(db.DateTime, nullable=True)  # utc; not before this
+    failed = db.Column(db.DateTime, nullable=True)  # gave up retrying (utc)
+    priority = db.Column(db.Integer, nullable=False, default=NORMAL, server_default='0')
 
     creator = db.relationship('Blogger')
 
+    @classmethod
+    def enqueue(cls, task, details, priority=NORMAL, delay=None, run_after=None, **kwargs):
+        """Add a task to the session, optionally not to run before a delay
+
+        `delay` is a timedelta from now; `run_after` a utc datetime.
+        """
+        if delay is not None:
+            run_after = datetime.utcnow() + delay
+        queued = cls(task=task, details=details, priority=priority,
+                     run_after=run_after, **kwargs)
+        db.session.add(queued)
+        return queued
+
+    def requeue(self):
+        """Give a failed task a fresh set of attempts"""
+        self.failed = None
+        self.started = None
+        self.run_after = None
+        self.attempts = 0
+        db.session.add(TaskUpdate(task=self, state='requeued'))
+
+    def get_last_error(self):
+        errors = [u for u in self.updates if u.state in ('retrying', 'failed')]
+        if errors:
+            return max(errors, key=lambda u: u.id).details.get('error')
+
+
+# serves claiming the next due task of a type: highest priority, then oldest
+_waiting_tasks = db.text('started IS NULL AND failed IS NULL')
+db.Index('ix_task_waiting_priority_created',
+         Task.task, Task.priority.desc(), Task.created, Task.id,
+         postgresql_where=_waiting_tasks, sqlite_where=_waiting_tasks)
+
 
 class TaskUpdate(db.Model):
     id = db.Column(db.Integer, primary_key=True)
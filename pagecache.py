@@ -0,0 +1,187 @@
+"""Cache rendered blog pages for anonymous visitors
+
+Stored pages are only served while their ETag still matches. Backends, by
+PAGE_CACHE_BACKEND: `lru` (default), `filesystem`, `null`, or 'module:Class'.
+"""
+
+from flask import Response, current_app, request
+from flask_login import current_user
+from hashlib import sha1
+from urllib.parse import urlencode
+import json
+import os
+import shutil
+import render_message
+import util
+from lru import LRUCache
+from util import write_atomic
+
+
+def app_version(app):
+    """Changes when a deploy could change how the same blog renders"""
+    version = sha1(render_message.__version__.encode())
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    for dirpath, dirnames, filenames in sorted(os.walk(template_dir)):
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            version.update(os.path.relpath(path, template_dir).encode())
+            with open(path, 'rb') as f:
+                version.update(f.read())
+    return version.hexdigest()[:16]
+
+
+def _remove_dir(path):
+    # move it aside first so concurrent writers can't repopulate it mid-delete
+    doomed = f'{path}.{os.getpid()}.doomed'
+    try:
+        os.rename(path, doomed)
+    except FileNotFoundError:
+        return
+    shutil.rmtree(doomed, ignore_errors=True)
+
+
+class NullBackend:
+    def __init__(self, app):
+        pass
+
+    def get(self, username, path):
+        return None
+
+    def set(self, username, path, page):
+        pass
+
+    def invalidate(self, username):
+        pass
+
+
+class LRUBackend:
+    def __init__(self, app):
+        self.pages = LRUCache(app.config['PAGE_CACHE_SIZE'])
+
+    def get(self, username, path):
+        return self.pages.get((username, path))
+
+    def set(self, username, path, page):
+        self.pages.set((username, path), page)
+
+    def invalidate(self, username):
+        self.pages.pop_where(lambda key: key[0] == username)
+
+
+class FileSystemBackend:
+    def __init__(self, app):
+        version = app_version(app)
+        self.directory = os.path.join(app.config['PAGE_CACHE_DIR'], version)
+        self.max_pages = app.config['PAGE_CACHE_BLOG_PAGES']
+        try:
+            others = [d for d in os.listdir(app.config['PAGE_CACHE_DIR'])
+                      if d != version and not d.endswith('.doomed')]
+        except FileNotFoundError:
+            others = []
+        for other in others:
+            _remove_dir(os.path.join(app.config['PAGE_CACHE_DIR'], other))
+
+    def _blog_dir(self, username):
+        return os.path.join(self.directory, username)
+
+    def _page_file(self, username, path):
+        return os.path.join(self._blog_dir(username),
+                            sha1(path.encode()).hexdigest() + '.json')
+
+    def get(self, username, path):
+        try:
+            with open(self._page_file(username, path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, username, path, page):
+        page_file = self._page_file(username, path)
+        write_atomic(page_file, json.dumps(page))
+        self._evict(self._blog_dir(username), keep=page_file)
+
+    def _evict(self, blog_dir, keep):
+        """remove the least recently stored pages past max_pages"""
+        pages = []
+        with os.scandir(blog_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json') and entry.path != keep:
+                    try:
+                        pages.append((entry.stat().st_mtime, entry.path))
+                    except FileNotFoundError:
+                        pass
+        for _, path in sorted(pages)[:max(len(pages) - self.max_pages + 1, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def invalidate(self, username):
+        _remove_dir(self._blog_dir(username))
+
+
+backends = {
+    'null': NullBackend,
+    'lru': LRUBackend,
+    'filesystem': FileSystemBackend,
+}
+
+
+def get_backend_class(name):
+    return util.get_backend_class(name, backends)
+
+
+class PageCache:
+
+    def init_app(self, app):
+        app.extensions['app_version'] = app_version(app)
+        backend_class = get_backend_class(app.config['PAGE_CACHE_BACKEND'])
+        app.extensions['page_cache'] = backend_class(app)
+
+    @property
+    def backend(self):
+        return current_app.extensions['page_cache']
+
+    @property
+    def app_version(self):
+        return current_app.extensions['app_version']
+
+    def invalidate(self, username):
+        self.backend.invalidate(username.lower())
+
+    @staticmethod
+    def cache_path():
+        # just the args blog views use, so made-up query strings share an entry
+        args = sorted((k, v) for k, v in request.args.items()
+                      if k in ('before', 'after'))
+        return f'{request.path}?{urlencode(args)}'
+
+    def serve(self, username, etag, render):
+        """Serve a blog page from the cache for anonymous visitors
+
+        The page is only served from the cache if it was stored for `etag`,
+        otherwise `render()` makes it (and it's stored for next time).
+        Logged-in visitors see their own nav (and owners see post controls),
+        so their pages are always rendered fresh.
+        """
+        if request.method != 'GET' or current_user.is_authenticated:
+            return current_app.make_response(render())
+
+        username, path = username.lower(), self.cache_path()
+        page = self.backend.get(username, path)
+        if page is not None and page.get('etag') == etag:
+            return Response(page['body'], content_type=page['content_type'],
+                            headers=page['headers'])
+
+        response = current_app.make_response(render())
+        if response.status_code == 200 and not response.is_streamed:
+            self.backend.set(username, path, {
+                'etag': etag,
+                'body': response.get_data(as_text=True),
+                'content_type': response.content_type,
+                'headers': {k: v for k, v in response.headers if k == 'Vary'},
+            })
+        return response
+
+
+page_cache = PageCache()
@@ -0,0 +1,109 @@
+from datetime import datetime
+from flask import abort
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload
+import limits
+from models import CommitPost
+
+
+CURSOR_DATETIME_FORMAT = '%Y%m%dT%H%M%S.%f'
+
+
+def make_cursor(post):
+    return '{}_{}'.format(
+        post.datetime.strftime(CURSOR_DATETIME_FORMAT), post.id)
+
+
+def parse_cursor(cursor):
+    try:
+        dt, post_id = cursor.split('_', 1)
+        return datetime.strptime(dt, CURSOR_DATETIME_FORMAT), int(post_id)
+    except ValueError:
+        abort(400, 'invalid page cursor')
+
+
+def blogger_posts(blogger):
+    return CommitPost.query \
+        .options(joinedload(CommitPost.repo)) \
+        .filter(CommitPost.blogger == blogger)
+
+
+def get_page(blogger, before=None, after=None,
+             per_page=limits.BLOG_POSTS_PER_PAGE):
+    """Keyset-paginate a blogger's posts on (datetime, id), newest first
+
+    `before` and `after` are cursors from `make_cursor`. Returns the page of
+    posts plus cursors for the newer and older pages (None if there isn't one).
+    """
+    posts = blogger_posts(blogger)
+    key = tuple_(CommitPost.datetime, CommitPost.id)
+
+    if after is not None:
+        page = posts \
+            .filter(key > parse_cursor(after)) \
+            .order_by(CommitPost.datetime.asc(), CommitPost.id.asc()) \
+            .limit(per_page + 1) \
+            .all()
+        has_newer, has_older = len(page) > per_page, True
+        page = page[:per_page][::-1]
+    else:
+        if before is not None:
+            posts = posts.filter(key < parse_cursor(before))
+        page = posts \
+            .order_by(CommitPost.datetime.desc(), CommitPost.id.desc()) \
+            .limit(per_page + 1) \
+            .all()
+        has_newer, has_older = before is not None, len(page) > per_page
+        page = page[:per_page]
+
+    newer = make_cursor(page[0]) if page and has_newer else None
+    older = make_cursor(page[-1]) if page and has_older else None
+    return page, newer, older
+
+
+class Page:
+    """A page of posts for templates: iterate it, then link on from it"""
+
+    def __init__(self, posts, newer, older):
+        self.posts = posts
+        self.newer = newer
+        self.older = older
+
+    def __iter__(self):
+        return iter(self.posts)
+
+
+class StreamedPage(Page):
+    """A page of posts pulled from the database in batches as it's iterated
+
+    Only knows its cursors (and which posts it `served`) once iteration is
+    done, which suits templates that link to the next page after their loop.
+    """
+
+    def __init__(self, blogger, before=None, per_page=limits.BLOG_POSTS_PER_PAGE,
+                 batch_size=20):
+        posts = blogger_posts(blogger)
+        if before is not None:
+            key = tuple_(CommitPost.datetime, CommitPost.id)
+            posts = posts.filter(key < parse_cursor(before))
+        super().__init__(posts, None, None)
+        self.served = []
+        self.has_newer = before is not None
+        self.per_page = per_page
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        posts = self.posts \
+            .order_by(CommitPost.datetime.desc(), CommitPost.id.desc()) \
+            .limit(self.per_page + 1) \
+            .yield_per(self.batch_size)
+        last = None
+        for n, post in enumerate(posts):
+            if n == self.per_page:
+                self.older = make_cursor(last)
+                break
+            if n == 0 and self.has_newer:
+                self.newer = make_cursor(post)
+            last = post
+            self.served.append(post)
+            yield post
@@ -0,0 +1,33 @@
+"""Count the SQL statements run while handling each request
+
+The count is reported in an `X-Query-Count` response header when
+QUERY_COUNT_HEADER is configured, so tests can keep views at a fixed number
+of queries instead of one-per-post.
+"""
+
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+def get_query_count():
+    return g.get('query_count', 0)
+
+
+def init_app(app):
+
+    @app.before_request
+    def reset_query_count():
+        g.query_count = 0
+
+    @app.after_request
+    def add_query_count_header(response):
+        if app.config['QUERY_COUNT_HEADER']:
+            response.headers['X-Query-Count'] = str(get_query_count())
+        return response
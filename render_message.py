@@ -1,26 +1,99 @@
 import bleach
 import markdown
+from bleach import html5lib_shim
+from bleach.linkifier import LinkifyFilter
 from bleach_allowlist import markdown_tags
 from collections import defaultdict
+from contextlib import contextmanager
 from functools import partial
+from hashlib import sha256
+from markupsafe import escape
+from multiprocessing import Pool, TimeoutError
 from markdown.extensions import Extension, codehilite
 from markdown.treeprocessors import Treeprocessor
 from mdx_gh_links import GithubLinks
+from pygments import highlight
+from pygments.formatters import get_formatter_by_name
+from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
+from lru import LRUCache
+from util import write_atomic
+import atexit
+import html
+import logging
+import os
+import threading
+import time
 
 
 # increment for any update that changes rendered output
-RENDER_CONFIG_VERSION = '0.2.2'
+RENDER_CONFIG_VERSION = '0.2.3'
 __version__ = f'{RENDER_CONFIG_VERSION}/markdown={markdown.__version__}'
 
 LINK_PREFIXES = ('www.', 'http://', 'https://', 'mailto:')
 
 
-base_extensions = (
-    codehilite.CodeHiliteExtension(guess_lang=False),
-    'fenced_code',
-    'footnotes',
-    'mdx_breakless_lists',
-)
+def get_base_extensions():
+    return (
+        codehilite.CodeHiliteExtension(guess_lang=False),
+        'fenced_code',
+        'footnotes',
+        'mdx_breakless_lists',
+    )
+
+class PygmentsCache:
+    """Lexers and formatters for codehilite, built once per alias and options
+
+    Highlighting time is tallied per lexer in `timings`, as
+    {lexer name: [blocks, seconds]}.
+    """
+
+    _missing = object()
+
+    def __init__(self, max_lexers=256, max_formatters=64):
+        self.lexers = LRUCache(max_lexers)
+        self.formatters = LRUCache(max_formatters)
+        self.timings = defaultdict(lambda: [0, 0.0])
+
+    @staticmethod
+    def _key(alias, options):
+        return alias, tuple(sorted((k, repr(v)) for k, v in options.items()))
+
+    def get_lexer_by_name(self, alias, **options):
+        key = self._key(alias, options)
+        lexer = self.lexers.get(key, self._missing)
+        if lexer is self._missing:
+            try:
+                lexer = get_lexer_by_name(alias, **options)
+            except ClassNotFound:
+                lexer = None
+            self.lexers.set(key, lexer)
+        if lexer is None:
+            raise ValueError(f'no lexer for alias {alias!r}')
+        return lexer
+
+    def get_formatter_by_name(self, alias, **options):
+        key = self._key(alias, options)
+        formatter = self.formatters.get(key)
+        if formatter is None:
+            formatter = get_formatter_by_name(alias, **options)
+            self.formatters.set(key, formatter)
+        return formatter
+
+    def highlight(self, code, lexer, formatter):
+        start = time.perf_counter()
+        highlighted = highlight(code, lexer, formatter)
+        timing = self.timings[lexer.name]
+        timing[0] += 1
+        timing[1] += time.perf_counter() - start
+        return highlighted
+
+
+pygments_cache = PygmentsCache()
+codehilite.get_lexer_by_name = pygments_cache.get_lexer_by_name
+codehilite.get_formatter_by_name = pygments_cache.get_formatter_by_name
+codehilite.highlight = pygments_cache.highlight
+
 
 allowed_attrs = {
     '*': ['id', 'class'],
@@ -50,6 +123,7 @@ class GHImageProcessor(Treeprocessor):
 class GithubLinksAlsoImages(GithubLinks):
     def __init__(self, *args, **kwargs):
         self.config = {
+            'domain': ['https://github.com', 'GitHub domain.'],
             'user': ['', 'GitHub user or organization.'],
             'repo': ['', 'Repository name.'],
             'sha': ['', 'Sha-1 hash of commit.'],
@@ -60,6 +134,52 @@ class GithubLinksAlsoImages(GithubLinks):
         super().extendMarkdown(md)
         md.treeprocessors.register(
             GHImageProcessor(self.getConfigs(), md), 'gh_image', 20)
+        # every processor got its own copy of the config. share one instead,
+        # so a reused Markdown instance can be pointed at each new commit.
+        self.commit = self.getConfigs()
+        for name in ('issue', 'mention', 'commit'):
+            md.inlinePatterns[name].config = self.commit
+        md.treeprocessors['gh_image'].config = self.commit
+
+    def set_commit(self, user, repo, sha):
+        self.commit.update(user=user, repo=repo, sha=sha)
+
+
+class MarkdownPool:
+    """Configured Markdown instances, reused across renders
+
+    Building a Markdown instance instantiates and registers every extension,
+    which costs more than converting a typical commit message. Instances are
+    handed out to one render at a time (so it's safe across threads and
+    greenlets) and reset() before going back in the pool.
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._idle = []
+
+    def build(self):
+        gh_links = GithubLinksAlsoImages()
+        md = markdown.Markdown(extensions=get_base_extensions() + (gh_links,))
+        md.gh_links = gh_links
+        return md
+
+    @contextmanager
+    def markdown(self, user, repo, sha):
+        try:
+            md = self._idle.pop()
+        except IndexError:
+            md = self.build()
+        md.gh_links.set_commit(user, repo, sha)
+        try:
+            yield md
+        finally:
+            md.reset()
+            if len(self._idle) < self.maxsize:
+                self._idle.append(md)
+
+
+markdown_pool = MarkdownPool()
 
 
 def only_abs_link(attrs, new=False):
@@ -68,8 +188,180 @@ def only_abs_link(attrs, new=False):
         return attrs
 
 
+class ResolveEntities(html5lib_shim.Filter):
+    """Turn entities into the characters they stand for, joining up the text
+
+    bleach.linkify re-parses its input, so after clean-then-linkify every
+    entity had been resolved (attribute values too), and linkify saw urls
+    with `&` in them whole.
+    This does the same inside the single-pass Cleaner.
+    """
+
+    def __iter__(self):
+        text = []
+        for token in super().__iter__():
+            if token['type'] == 'Characters':
+                text.append(token['data'])
+            elif token['type'] == 'Entity':
+                text.append(html.unescape(f'&{token["name"]};'))
+            else:
+                if text:
+                    yield {'type': 'Characters', 'data': ''.join(text)}
+                    text = []
+                if token['type'] in ('StartTag', 'EmptyTag'):
+                    token['data'] = {name: html5lib_shim.convert_entities(value)
+                                     for name, value in token['data'].items()}
+                yield token
+        if text:
+            yield {'type': 'Characters', 'data': ''.join(text)}
+
+
+_local = threading.local()
+
+
+def get_cleaner():
+    """A Cleaner that sanitises and then linkifies, in one html parse
+
+    Same output as bleach.clean followed by bleach.linkify, without parsing
+    and serialising everything twice. Cleaners hold parser state, so each
+    thread gets its own.
+    """
+    try:
+        return _local.cleaner
+    except AttributeError:
+        linkify = partial(LinkifyFilter, callbacks=[only_abs_link], skip_tags=['code'])
+        cleaner = _local.cleaner = bleach.Cleaner(
+            markdown_tags, allowed_attrs, filters=[ResolveEntities, linkify])
+        return cleaner
+
+
+class RenderCache:
+    """Rendered HTML, addressed by a hash of everything that affects it
+
+    The key covers the message text, the commit it links against, and the
+    renderer version, so entries never need invalidating: a renderer update
+    just stops hitting the old ones. Recent renders are kept in memory, and
+    with a `directory` every render is also kept on disk, where other
+    processes (and later runs) can find it.
+    """
+
+    def __init__(self, maxsize=1024, directory=None):
+        self.configure(maxsize, directory)
+
+    def configure(self, maxsize=1024, directory=None):
+        self.memory = LRUCache(maxsize)
+        self.directory = directory
+
+    @staticmethod
+    def key(text, user, repo, sha):
+        parts = (text, user, repo, sha, __version__)
+        return sha256('\0'.join(parts).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.html')
+
+    def get(self, key):
+        html = self.memory.get(key)
+        if html is None and self.directory is not None:
+            try:
+                with open(self._path(key), encoding='utf-8') as f:
+                    html = f.read()
+            except OSError:
+                return None
+            self.memory.set(key, html)
+        return html
+
+    def set(self, key, html):
+        self.memory.set(key, html)
+        if self.directory is not None:
+            write_atomic(self._path(key), html)
+
+
+render_cache = RenderCache()
+
+
 def render_github(text, user, repo, sha):
-    extras = (GithubLinksAlsoImages(user=user, repo=repo, sha=sha),)
-    html = markdown.markdown(text, extensions=base_extensions + extras)
-    safe = bleach.clean(html, markdown_tags, allowed_attrs)
-    return bleach.linkify(safe, callbacks=[only_abs_link], skip_tags=['code'])
+    key = render_cache.key(text, user, repo, sha)
+    html = render_cache.get(key)
+    if html is None:
+        html = render_github_uncached(text, user, repo, sha)
+        render_cache.set(key, html)
+    return html
+
+
+def render_fallback(text):
+    """the message as escaped plain text, for when it can't be rendered"""
+    return f'<pre class="render-fallback">{escape(text)}</pre>'
+
+
+def _render_in_worker(args):
+    return render_github_uncached(*args)
+
+
+class RenderGuard:
+    """Render in a killable process pool, within size and time limits
+
+    render() returns (html, fallback): fallback is None, or the reason the html
+    is the escaped message instead.
+    """
+
+    def __init__(self, max_bytes=64 * 1024, timeout=10, workers=2):
+        self.pool = None
+        self.lock = threading.Lock()
+        self.configure(max_bytes, timeout, workers)
+
+    def configure(self, max_bytes=64 * 1024, timeout=10, workers=2):
+        self.close()
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.workers = workers
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.terminate()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = Pool(self.workers)
+            return self.pool
+
+    def discard(self, pool):
+        """kill a pool with a stuck render, and forget it if it's still current"""
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.terminate()
+
+    def render(self, text, user, repo, sha):
+        if len(text.encode()) > self.max_bytes:
+            logging.warning(f'not rendering {user}/{repo}@{sha}: over {self.max_bytes} bytes')
+            return render_fallback(text), 'too large'
+        key = render_cache.key(text, user, repo, sha)
+        if (html := render_cache.get(key)) is not None:
+            return html, None
+        if not self.timeout:
+            return render_github(text, user, repo, sha), None
+
+        pool = self.get_pool()
+        pending = pool.apply_async(_render_in_worker, [(text, user, repo, sha)])
+        try:
+            html = pending.get(self.timeout)
+        except TimeoutError:
+            logging.warning(f'gave up rendering {user}/{repo}@{sha} after {self.timeout}s')
+            self.discard(pool)
+            return render_fallback(text), 'timed out'
+        render_cache.set(key, html)
+        return html, None
+
+
+render_guard = RenderGuard()
+atexit.register(render_guard.close)
+
+
+def render_github_uncached(text, user, repo, sha):
+    with markdown_pool.markdown(user, repo, sha) as md:
+        html = md.convert(text)
+    return get_cleaner().clean(html)
@@ -1,14 +1,27 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from flask import current_app
+from functools import partial
 from flask_mail import Message
-from sqlalchemy import func
+from datetime import datetime, timedelta
+from sqlalchemy import func, or_, update
 from sqlalchemy.exc import OperationalError
 import logging
 import pygit2
+import random
+import signal
 import sys
+import threading
 import time
+import traceback
 
+import feeds
+import limits
+import util
 from emails import mail, templates
-from models import db, Repo, Task
+from models import db, CommitPost, Repo, Task, TaskUpdate
+from pagecache import page_cache
+from wakeup import task_wakeup
 
 
 logging.basicConfig(
@@ -17,32 +30,87 @@ logging.basicConfig(
 
 
 
-def take_task(of_type=None, max_retry=3):
+def due_tasks(of_type=None):
+    """Waiting tasks that may run now, highest priority and then oldest first"""
     q = Task.query \
-        .order_by(Task.created.asc()) \
-        .filter(Task.started.is_(None))
-
+        .order_by(Task.priority.desc(), Task.created.asc(), Task.id.asc()) \
+        .filter(Task.started.is_(None)) \
+        .filter(Task.failed.is_(None)) \
+        .filter(or_(Task.run_after.is_(None), Task.run_after <= datetime.utcnow()))
     if of_type is not None:
         q = q.filter(Task.task == of_type)
+    return q
 
-    try:
-        with db.session.begin_nested():
-            if task := q.first():
-                task.started = func.now()
-                db.session.add(task)
-    except OperationalError:
-        db.session.rollback()
-        if max_retry > 0:
-            return take_task(of_type, max_retry - 1)
 
-    return task
+def next_due_in(task_types=None):
+    """Seconds until the soonest delayed task may run, or None if none are waiting"""
+    q = Task.query \
+        .filter(Task.started.is_(None)) \
+        .filter(Task.failed.is_(None)) \
+        .filter(Task.run_after > datetime.utcnow()) \
+        .with_entities(func.min(Task.run_after))
+    if task_types is not None:
+        q = q.filter(Task.task.in_(task_types))
+    soonest = q.scalar()
+    if soonest is None:
+        return None
+    return max((soonest - datetime.utcnow()).total_seconds(), 0)
+
+
+def _poll_timeout(poll_interval, task_types=None):
+    """wait no longer than the poll interval, or until a delayed task is due"""
+    due_in = next_due_in(task_types)
+    db.session.rollback()  # don't sit in a transaction while waiting
+    return poll_interval if due_in is None else min(poll_interval, due_in)
+
 
+def _claim_skip_locked(of_type):
+    """one UPDATE ... RETURNING, skipping rows other runners are claiming"""
+    next_task = due_tasks(of_type) \
+        .with_entities(Task.id) \
+        .limit(1) \
+        .with_for_update(skip_locked=True) \
+        .scalar_subquery()
+    claim = update(Task) \
+        .where(Task.id == next_task) \
+        .values(started=func.now()) \
+        .returning(Task.id)
+    return db.session.execute(claim).scalar()
 
-def get_tasks(of_type=None, poll_interval=1):
-    while True:
-        if task := take_task(of_type):
-            yield task
-        time.sleep(poll_interval)
+
+def _claim_conditional(of_type):
+    """set `started` only if it's still unset, moving on if someone beat us"""
+    while candidate := due_tasks(of_type).with_entities(Task.id).first():
+        claimed = Task.query \
+            .filter(Task.id == candidate.id, Task.started.is_(None)) \
+            .update({Task.started: func.now()}, synchronize_session=False)
+        if claimed:
+            return candidate.id
+    return None
+
+
+def take_task(of_type=None, max_retry=3):
+    """Claim the next due task, or return None if there aren't any
+
+    The highest-priority task goes first, then the oldest; tasks with a
+    `run_after` in the future are left until then.
+
+    Claims are atomic and committed right away, so any number of runners
+    can share a queue and each task is taken exactly once.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        claim = _claim_skip_locked
+    else:
+        claim = _claim_conditional
+    for _ in range(max_retry + 1):
+        try:
+            task_id = claim(of_type)
+            db.session.commit()
+        except OperationalError:
+            db.session.rollback()  # eg. sqlite's database is locked
+            continue
+        return Task.query.get(task_id) if task_id is not None else None
+    return None
 
 
 _task_handlers = {}
@@ -76,33 +144,197 @@ def email(task):
     mail.send(msg)
 
 
-def run(task_type=None):
+@handle_task
+def render(task):
+    post = CommitPost.query \
+        .join(CommitPost.repo) \
+        .filter(Repo.full_name == task.details['full_name']) \
+        .filter(CommitPost.hex == task.details['hex']) \
+        .one_or_none()
+    if post is None or post.render_fallback != 'pending':
+        logging.info('\tpost was unposted or rerendered already, nothing to do')
+        return
+    _apply_rerender(post)
+
+
+@handle_task
+def rerender(task):
+    post = CommitPost.query.get(task.details['post_id'])
+    if post is None or not post.can_rerender():
+        logging.info('\tpost was unposted or rerendered already, nothing to do')
+        return
+    _apply_rerender(post)
+
+
+def _apply_rerender(post):
+    post.apply_rerender()
+    feeds.invalidate(post.blogger)
+    post.blogger.touch_blog()
+    db.session.commit()
+    page_cache.invalidate(post.blogger.username)
+
+
+def retry_delay(attempt):
+    """exponential backoff, with jitter so failures don't retry in lockstep"""
+    delay = min(limits.TASK_RETRY_DELAY * 2 ** (attempt - 1), limits.TASK_RETRY_MAX_DELAY)
+    return timedelta(seconds=delay / 2 + random.uniform(0, delay / 2))
+
+
+def record_failure(task, error):
+    """Put the task back in the queue for a later retry, or give up on it"""
+    db.session.rollback()  # whatever the handler left half-done
+    max_attempts = limits.TASK_MAX_ATTEMPTS.get(task.task, limits.TASK_DEFAULT_MAX_ATTEMPTS)
+    details = {
+        'attempt': task.attempts,
+        'error': f'{type(error).__name__}: {error}',
+        'traceback': ''.join(traceback.format_exception(type(error), error, error.__traceback__)),
+    }
+    task.started = None
+    if task.attempts < max_attempts:
+        task.run_after = datetime.utcnow() + retry_delay(task.attempts)
+        details['run_after'] = task.run_after.isoformat()
+        state = 'retrying'
+    else:
+        task.failed = datetime.utcnow()
+        state = 'failed'
+    db.session.add(TaskUpdate(task=task, state=state, details=details))
+    db.session.commit()
+    logging.info(f'\ttask {task.task} ({task.id}) {state} after attempt {task.attempts}')
+
+
+def run_task(task):
+    try:
+        handler = _task_handlers[task.task]
+    except KeyError:
+        logging.error(f'handler not found for task {task.task}')
+        raise
+    logging.info(f'found task {task.task} ({task.id}) task. handling...')
+    task.attempts += 1
+    db.session.commit()
+    try:
+        handler(task)
+    except Exception as e:
+        logging.error(f'oh no, task {task.task} errored out: {task}:\n{e}')
+        logging.exception(e)
+        record_failure(task, e)
+    else:
+        task.completed = func.now()
+        db.session.add(task)
+        db.session.add(TaskUpdate(task=task, state='completed',
+                                  details={'attempt': task.attempts}))
+        try:
+            db.session.commit()
+        except OperationalError as e:
+            logging.error(f'oh no, task {task.task} completed, but committing completion errored out: {task}:\n{e}')
+            db.session.rollback()
+        else:
+            logging.info(f'\tcompleted task {task.task} ({task.id}). woo!')
+
+
+def _run_in_thread(app, task_id):
+    with app.app_context():
+        run_task(Task.query.get(task_id))
+
+
+def _run_in_process(task_id):
+    with util.worker_app.app_context():
+        run_task(Task.query.get(task_id))
+
+
+class Runner:
+    """Run tasks concurrently, up to a limit per task type
+
+    drain() stops taking tasks; run() returns once the running ones finish.
+    """
+
+    def __init__(self, app, limits=None, processes=(), task_types=None,
+                 poll_interval=None):
+        self.app = app
+        self.task_types = task_types or list(_task_handlers)
+        self.limits = {t: (limits or {}).get(t, 1) for t in self.task_types}
+        self.processes = set(processes) & set(self.task_types)
+        self.poll_interval = poll_interval or app.config['TASK_POLL_INTERVAL']
+        self.running = defaultdict(int)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.draining = False
+
+    def drain(self, *_):
+        logging.info('draining: finishing running tasks, not taking new ones')
+        self.draining = True
+        self.wake.set()
+
+    def listen(self):
+        with self.app.app_context():
+            while not self.draining:
+                try:
+                    with task_wakeup.listen() as wait:
+                        while not self.draining:
+                            wait(_poll_timeout(self.poll_interval, self.task_types))
+                            self.wake.set()
+                except Exception as e:
+                    # eg. a locked sqlite db, or a dropped LISTEN connection
+                    logging.error(f'task wakeup listener failed, restarting it: {e}')
+                    db.session.rollback()
+                    self.wake.set()
+                    time.sleep(1)
+
+    def finished(self, task_type, future):
+        if (e := future.exception()) is not None:
+            logging.error(f'oh no, running a {task_type} task failed: {e}')
+        with self.lock:
+            self.running[task_type] -= 1
+        self.wake.set()
+
+    def has_room(self, task_type):
+        with self.lock:
+            return self.running[task_type] < self.limits[task_type]
+
+    def take_tasks(self, threads, processes):
+        for task_type in self.task_types:
+            while not self.draining and self.has_room(task_type) \
+                    and (task := take_task(task_type)):
+                with self.lock:
+                    self.running[task_type] += 1
+                if task_type in self.processes:
+                    future = processes.submit(_run_in_process, task.id)
+                else:
+                    future = threads.submit(_run_in_thread, self.app, task.id)
+                future.add_done_callback(partial(self.finished, task_type))
+
+    def run(self):
+        thread_slots = sum(n for t, n in self.limits.items() if t not in self.processes)
+        process_slots = sum(n for t, n in self.limits.items() if t in self.processes)
+        threads = ThreadPoolExecutor(max(thread_slots, 1))
+        processes = ProcessPoolExecutor(process_slots, initializer=util.init_worker) \
+            if process_slots else None
+        threading.Thread(target=self.listen, daemon=True).start()
+        try:
+            with self.app.app_context():
+                while not self.draining:
+                    self.wake.clear()
+                    try:
+                        self.take_tasks(threads, processes)
+                    except Exception as e:
+                        logging.error(f'could not take tasks: {e}')
+                        db.session.rollback()
+                    self.wake.wait(self.poll_interval)
+        finally:
+            threads.shutdown(wait=True)
+            if processes is not None:
+                processes.shutdown(wait=True)
+        logging.info('all running tasks finished, bye!')
+
+
+def run(task_type=None, limits=None, processes=()):
     logging.info('hello! i am a task runner.')
     if task_type is None:
         logging.info(f'running tasks with handlers for: %s', ','.join(_task_handlers))
     else:
         logging.info(f'running for only {task_type} tasks')
 
-    for task in get_tasks(task_type):
-        try:
-            handler = _task_handlers[task.task]
-        except KeyError:
-            logging.error(f'handler not found for task {task.task}')
-            raise
-        logging.info(f'found task {task.task} ({task.id}) task. handling...')
-        try:
-            handler(task)
-        except Exception as e:
-            logging.error(f'oh no, task {task.task} errored out: {task}:\n{e}')
-            logging.exception(e)
-        else:
-            task.completed = func.now()
-            db.session.add(task)
-            try:
-                db.session.commit()
-            except OperationalError as e:
-                logging.error(f'oh no, task {task.task} completed, but committing completion errored out: {task}:\n{e}')
-                db.session.rollback()
-            else:
-                logging.info(f'\tcompleted task {task.task} ({task.id}). woo!')
-
+    runner = Runner(current_app._get_current_object(), limits=limits,
+        processes=processes, task_types=task_type and [task_type])
+    signal.signal(signal.SIGTERM, runner.drain)
+    signal.signal(signal.SIGINT, runner.drain)
+    runner.run()
@@ -1,4 +1,6 @@
 import datetime
+import hashlib
+import itertools
 import json
 import os
 import pytest
@@ -8,9 +10,11 @@ from commitblog import create_app
 from flask import g, session
 from flask_login import FlaskLoginClient, login_user
 from flask_wtf.csrf import generate_csrf as wtf_generate_csrf
-from models import Blogger, db
+from models import Blogger, CommitPost, Repo, db
 from models.auth import OAuth2Client, OAuth2Token
 from oauth import token_db_parts
+import feeds
+from pagecache import page_cache
 from known_git_hosts.github import gh
 
 
@@ -146,6 +150,57 @@ def login(app):
     return login_client
 
 
+@pytest.fixture
+def commit_post(app_ctx):
+
+    seq = itertools.count(1)
+
+    def make_commit_post(blogger, message, repo_name='uniphil/commit--blog',
+                         when=None, hex=None, **kwargs):
+        n = next(seq)
+        repo, _ = Repo.get_or_create(repo_name)
+        post = CommitPost(
+            hex=hex or hashlib.sha1(str(n).encode()).hexdigest(),
+            message=message,
+            datetime=when or datetime.datetime(2021, 1, 1) + datetime.timedelta(hours=n),
+            repo=repo,
+            blogger=blogger,
+            **kwargs)
+        db.session.add(post)
+        db.session.flush()
+        with app_ctx.app.test_request_context():
+            feeds.refresh(blogger)
+        blogger.touch_blog()
+        db.session.commit()
+        page_cache.invalidate(blogger.username)
+        return post
+
+    return make_commit_post
+
+
+@pytest.fixture
+def make_stale(app_ctx):
+
+    def stale(*posts):
+        for post in posts:
+            post.markdown_body = '<p>old</p>'
+            post.markdown_renderer = '0.0.1'
+        db.session.commit()
+
+    return stale
+
+
+@pytest.fixture
+def blog_host(app):
+    """turn on subdomain routing so blog pages can be requested"""
+    app.config['SERVER_NAME'] = 'commit--blog.test'
+
+    def host_for(blogger):
+        return f'https://{blogger.username}.commit--blog.test'
+
+    return host_for
+
+
 @pytest.fixture
 def fake_github():
 
@@ -184,12 +239,10 @@ def oauth_app(app_ctx):
 @pytest.fixture
 def token_for(oauth_app):
 
-    def seq(_n=[0]):
-        _n[0] += 1
-        return _n[0]
+    seq = itertools.count(1)
 
     def get_new_token(blogger):
-        token_string = f'asdfasdf-asdf-{seq()}' * 5
+        token_string = f'asdfasdf-asdf-{next(seq)}' * 5
         selector, validator = token_db_parts(token_string)
         token = OAuth2Token(
             client=oauth_app,
@@ -99,6 +99,7 @@ def test_add_gh_email(app_ctx, login, gh_blogger):
         .filter(Task.details['recipient'].as_string() == 'jel@example.com') \
         .filter(Task.details['message'].as_string() == 'confirm_email')
     assert email_confirms.count() == 1, 'one email task should be created'
+    assert email_confirms.one().priority == Task.URGENT
 
 
 def test_add_email(app_ctx, login, gh_blogger):
@@ -175,3 +176,74 @@ def test_revoke_oauth(app_ctx, login, token_for, token_login, gh_blogger):
         assert resp.status_code == 200
         assert b'Access token revoked' in resp.data
         assert b'This app can create, view, and update posts' not in resp.data
+
+
+def test_rerender_preview_is_remembered(app_ctx, monkeypatch, login, gh_blogger, commit_post, make_stale):
+    post = commit_post(gh_blogger, 'preview\n\nme *twice*')
+    make_stale(post)
+    renders = []
+    render = CommitPost.render
+    monkeypatch.setattr(CommitPost, 'render', lambda self: renders.append(self.id) or render(self))
+
+    with login(gh_blogger) as client:
+        for _ in range(2):
+            resp = client.get(f'/{post.repo.full_name}/{post.hex}/rerender')
+            assert resp.status_code == 200
+            assert b'<em>twice</em>' in resp.data
+        assert renders == [post.id]
+        assert CommitPost.query.get(post.id).can_rerender()
+
+        client.get('/account/rerender')  # the batch page reuses it too
+        assert renders == [post.id]
+        resp = client.post(f'/{post.repo.full_name}/{post.hex}/rerender',
+                           data={'csrf_token': client.csrf_token})
+        assert resp.status_code == 302
+        assert renders == [post.id]
+    assert not CommitPost.query.get(post.id).can_rerender()
+
+
+def test_rerender_batch(app_ctx, login, gh_blogger, blogger, commit_post, make_stale):
+    mine = [commit_post(gh_blogger, f'post {n}\n\n*body* {n}') for n in range(3)]
+    for post in mine:
+        make_stale(post)
+    someone_elses = commit_post(blogger('other', 'Other'), 'not\n\nyours')
+    make_stale(someone_elses)
+
+    with login(gh_blogger) as client:
+        resp = client.get('/account/rerender')
+        assert resp.status_code == 200
+        assert resp.data.count(b'+&lt;p&gt;&lt;em&gt;body&lt;/em&gt;') == 3
+        assert b'not' not in resp.data.split(b'</header>')[1]
+
+        resp = client.post('/account/rerender', data={
+            'csrf_token': client.csrf_token,
+            'post': [mine[0].id, mine[1].id, someone_elses.id],
+        })
+        assert resp.status_code == 302
+
+    assert [CommitPost.query.get(p.id).can_rerender() for p in mine] == [False, False, True]
+    assert CommitPost.query.get(someone_elses.id).can_rerender()
+
+
+def test_rerender_batch_with_bodyless_post(app_ctx, login, gh_blogger, commit_post, make_stale):
+    post = commit_post(gh_blogger, 'just a title')
+    make_stale(post)
+    with login(gh_blogger) as client:
+        assert client.get('/account/rerender').status_code == 200
+        resp = client.post('/account/rerender', data={
+            'csrf_token': client.csrf_token, 'post': [post.id]})
+        assert resp.status_code == 302
+    post = CommitPost.query.get(post.id)
+    assert not post.can_rerender()
+    assert post.markdown_body == ''
+
+
+def test_rerender_preview_forgets_fallbacks(app_ctx, monkeypatch, gh_blogger, commit_post, make_stale):
+    post = commit_post(gh_blogger, 'slow\n\nto *render*')
+    make_stale(post)
+    results = [('<pre>slow</pre>', 'timed out'), ('<p>to <em>render</em></p>', None)]
+    monkeypatch.setattr(CommitPost, 'render', lambda self: results.pop(0))
+    assert post.get_rerender_preview() == '<pre>slow</pre>'
+    post.apply_rerender()
+    assert post.render_fallback is None
+    assert post.markdown_body == '<p>to <em>render</em></p>'
@@ -1,3 +1,6 @@
+from datetime import datetime
+from models import db, Task
+
 
 def test_add_client_app(app_ctx, login, admin):
     with login(admin) as client:
@@ -26,3 +29,20 @@ def test_create_client_app_non_admin(app_ctx, login, gh_blogger):
             'token_auth_method': 'none',
         })
         assert resp.status_code == 401
+
+
+def test_requeue_failed_task(app_ctx, login, admin):
+    task = Task(task='email', details={}, creator=admin, attempts=6,
+                failed=datetime.utcnow())
+    db.session.add(task)
+    db.session.commit()
+    with login(admin) as client:
+        resp = client.get('/admin/')
+        assert resp.status_code == 200
+        assert b'requeue' in resp.data
+        resp = client.post(f'/admin/tasks/{task.id}/requeue',
+                           data={'csrf_token': client.csrf_token})
+        assert resp.status_code == 302
+    task = Task.query.get(task.id)
+    assert task.failed is None and task.attempts == 0
+    assert [u.state for u in task.updates] == ['requeued']
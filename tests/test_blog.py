@@ -0,0 +1,404 @@
+import datetime
+import os
+import pytest
+import render_message
+from paging import get_page, make_cursor
+from models import db, CommitPost, Task
+from pagecache import page_cache
+import tasks
+import limits
+
+
+@pytest.fixture
+def many_posts(gh_blogger, commit_post):
+    return [commit_post(gh_blogger, f'post number {n}') for n in range(45)]
+
+
+def test_blog_list(client, gh_blogger, commit_post, blog_host):
+    commit_post(gh_blogger, 'a first post')
+    resp = client.get('/', base_url=blog_host(gh_blogger))
+    assert resp.status_code == 200
+    assert b'a first post' in resp.data
+    assert b'older' not in resp.data
+
+
+def test_get_page_keyset(app_ctx, gh_blogger, many_posts):
+    newest_first = many_posts[::-1]
+
+    page, newer, older = get_page(gh_blogger, per_page=20)
+    assert page == newest_first[:20]
+    assert newer is None
+    assert older == make_cursor(newest_first[19])
+
+    page, newer, older = get_page(gh_blogger, before=older, per_page=20)
+    assert page == newest_first[20:40]
+    assert newer == make_cursor(newest_first[20])
+
+    page, newer, older = get_page(gh_blogger, before=older, per_page=20)
+    assert page == newest_first[40:]
+    assert older is None
+
+    # and back again
+    page, newer, older = get_page(gh_blogger, after=newer, per_page=20)
+    assert page == newest_first[20:40]
+    page, newer, older = get_page(gh_blogger, after=newer, per_page=20)
+    assert page == newest_first[:20]
+    assert newer is None
+
+
+def test_get_page_same_datetime(app_ctx, gh_blogger, commit_post):
+    when = datetime.datetime(2021, 6, 1)
+    posts = [commit_post(gh_blogger, f'same time {n}', when=when) for n in range(5)]
+    page, _, older = get_page(gh_blogger, per_page=3)
+    rest, _, _ = get_page(gh_blogger, before=older, per_page=3)
+    assert page + rest == posts[::-1]
+
+
+def test_blog_list_pages(client, gh_blogger, many_posts, blog_host):
+    resp = client.get('/', base_url=blog_host(gh_blogger))
+    assert resp.status_code == 200
+    assert resp.data.count(b'<article>') == limits.BLOG_POSTS_PER_PAGE
+    assert b'older' in resp.data
+    assert b'newer' not in resp.data
+
+    cursor = make_cursor(many_posts[-limits.BLOG_POSTS_PER_PAGE])
+    resp = client.get('/', base_url=blog_host(gh_blogger),
+                      query_string={'before': cursor})
+    assert resp.status_code == 200
+    assert b'newer' in resp.data
+
+    resp = client.get('/', base_url=blog_host(gh_blogger),
+                      query_string={'before': 'nope'})
+    assert resp.status_code == 400
+
+
+@pytest.mark.parametrize('path', ('/', '/feed'))
+def test_blog_queries_dont_grow_with_posts(client, gh_blogger, commit_post, blog_host, path):
+    host = blog_host(gh_blogger)
+    commit_post(gh_blogger, 'just one\n\nfor now', repo_name='uniphil/one')
+    db.session.expunge_all()  # nothing preloaded in the identity map
+    resp = client.get(path, base_url=host)
+    assert resp.status_code == 200
+    few_posts_queries = int(resp.headers['X-Query-Count'])
+
+    gh_blogger = db.session.merge(gh_blogger)
+    for n in range(10):
+        commit_post(gh_blogger, f'another\n\nposted {n}', repo_name=f'uniphil/repo-{n}')
+    db.session.expunge_all()
+    resp = client.get(path, base_url=host)
+    assert resp.status_code == 200
+    assert int(resp.headers['X-Query-Count']) == few_posts_queries
+
+
+def test_blog_post_queries(client, gh_blogger, commit_post, blog_host):
+    post = commit_post(gh_blogger, 'a post\n\nwith a body')
+    resp = client.get(f'/{post.repo.full_name}/{post.hex}', base_url=blog_host(gh_blogger))
+    assert resp.status_code == 200
+    assert int(resp.headers['X-Query-Count']) <= 3
+
+
+@pytest.mark.parametrize('path', ('/', '/feed'))
+def test_conditional_get(client, gh_blogger, commit_post, blog_host, path):
+    host = blog_host(gh_blogger)
+    commit_post(gh_blogger, 'hello\n\nworld')
+    resp = client.get(path, base_url=host)
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+    assert 'Last-Modified' not in resp.headers
+
+    resp = client.get(path, base_url=host, headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.data == b''
+    # post dates aren't modification times, so they can't answer this alone
+    resp = client.get(path, base_url=host,
+                      headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+    assert resp.status_code == 200
+
+    # a new post changes the validator
+    commit_post(gh_blogger, 'another\n\npost')
+    resp = client.get(path, base_url=host, headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+
+
+def test_conditional_get_is_constant_cost(client, gh_blogger, commit_post, blog_host):
+    host = blog_host(gh_blogger)
+    etag = None
+    for n in range(10):
+        commit_post(gh_blogger, f'post {n}\n\nbody')
+        resp = client.get('/', base_url=host, headers={'If-None-Match': etag or ''})
+        assert resp.headers['ETag'] != etag
+        etag = resp.headers['ETag']
+        resp = client.get('/', base_url=host, headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert int(resp.headers['X-Query-Count']) == 1  # just the blogger
+
+
+def test_conditional_get_depends_on_viewer(app, login, gh_blogger, commit_post, blog_host):
+    host = blog_host(gh_blogger)
+    post = commit_post(gh_blogger, 'hello\n\nworld')
+    path = f'/{post.repo.full_name}/{post.hex}'
+    with app.test_client() as anon:
+        anon_etag = anon.get(path, base_url=host).headers['ETag']
+    with login(gh_blogger) as client:
+        resp = client.get(path, base_url=host, headers={'If-None-Match': anon_etag})
+        assert resp.status_code == 200
+        assert b'Unpost' in resp.data
+
+
+def test_page_cache(client, gh_blogger, commit_post, blog_host):
+    host = blog_host(gh_blogger)
+    commit_post(gh_blogger, 'hello\n\nworld')
+    first = client.get('/', base_url=host)
+    assert first.status_code == 200
+    assert int(first.headers['X-Query-Count']) > 0
+
+    cached = client.get('/', base_url=host)
+    assert cached.data == first.data
+    assert cached.headers['ETag'] == first.headers['ETag']
+    assert int(cached.headers['X-Query-Count']) == 1  # just the blogger
+
+    # only the args the views use make separate entries
+    cached = client.get('/?utm_source=somewhere', base_url=host)
+    assert cached.data == first.data
+    assert int(cached.headers['X-Query-Count']) == 1
+
+    resp = client.get('/', base_url=host, headers={'If-None-Match': first.headers['ETag']})
+    assert resp.status_code == 304
+
+
+def test_page_cache_invalidated_on_write(app, no_csrf, login, gh_blogger, commit_post, blog_host):
+    host = blog_host(gh_blogger)
+    commit_post(gh_blogger, 'hello\n\nworld')
+    with app.test_client() as anon:
+        assert b'Jem' in anon.get('/', base_url=host).data
+        with login(gh_blogger) as client:
+            resp = client.post('/account/name', data={'display_name': 'Jemima'})
+            assert resp.status_code == 302
+        assert b'Jemima' in anon.get('/', base_url=host).data
+
+
+def test_page_cache_checks_etag(app, gh_blogger, commit_post, blog_host):
+    # eg. a write from another process, which can't invalidate this one's cache
+    host = blog_host(gh_blogger)
+    commit_post(gh_blogger, 'hello\n\nworld')
+    with app.test_client() as anon:
+        first = anon.get('/', base_url=host)
+        gh_blogger.name = 'Jemima'
+        db.session.commit()
+        resp = anon.get('/', base_url=host)
+        assert b'Jemima' in resp.data
+        assert resp.headers['ETag'] != first.headers['ETag']
+
+
+def test_page_cache_skips_logged_in(login, gh_blogger, commit_post, blog_host):
+    host = blog_host(gh_blogger)
+    commit_post(gh_blogger, 'hello\n\nworld')
+    with login(gh_blogger) as client:
+        client.get('/', base_url=host)
+        resp = client.get('/', base_url=host)
+        assert int(resp.headers['X-Query-Count']) > 0
+
+
+@pytest.mark.parametrize('backend', ('lru', 'filesystem'))
+def test_page_cache_backends(app, tmp_path, backend):
+    from pagecache import get_backend_class
+    app.config.update(PAGE_CACHE_SIZE=2, PAGE_CACHE_DIR=str(tmp_path))
+    cache = get_backend_class(backend)(app)
+    page = {'body': 'hi', 'content_type': 'text/html', 'headers': {}}
+    cache.set('a', '/?', page)
+    cache.set('b', '/?', page)
+    assert cache.get('a', '/?') == page
+    cache.invalidate('a')
+    assert cache.get('a', '/?') is None
+    assert cache.get('b', '/?') == page
+
+
+def test_page_cache_filesystem_is_bounded_and_versioned(app, tmp_path, monkeypatch):
+    from pagecache import FileSystemBackend
+    app.config.update(PAGE_CACHE_DIR=str(tmp_path), PAGE_CACHE_BLOG_PAGES=3)
+    cache = FileSystemBackend(app)
+    page = {'body': 'hi', 'content_type': 'text/html', 'headers': {}}
+    for n in range(5):
+        cache.set('a', f'/?before={n}', page)
+    stored = [n for n in range(5) if cache.get('a', f'/?before={n}') == page]
+    assert len(stored) == 3 and 4 in stored
+
+    monkeypatch.setattr(render_message, '__version__', 'next')
+    cache = FileSystemBackend(app)
+    assert cache.get('a', '/?before=4') is None
+    assert os.listdir(tmp_path) == []  # the old version's pages are cleared out
+
+
+def test_feed_is_bounded_and_paged(app, client, gh_blogger, commit_post, blog_host):
+    app.config['FEED_MAX_ENTRIES'] = 5
+    host = blog_host(gh_blogger)
+    posts = [commit_post(gh_blogger, f'post {n}\n\nbody {n}') for n in range(12)]
+
+    resp = client.get('/feed', base_url=host)
+    assert resp.status_code == 200
+    assert resp.data.count(b'<entry') == 5
+    assert b'post 11' in resp.data
+    assert b'rel="first"' in resp.data
+    assert b'rel="previous"' not in resp.data
+    next_cursor = make_cursor(posts[7])
+    assert f'before={next_cursor}'.encode() in resp.data
+
+    resp = client.get('/feed', base_url=host, query_string={'before': next_cursor})
+    assert resp.data.count(b'<entry') == 5
+    assert b'post 6' in resp.data
+    assert b'rel="previous"' in resp.data
+    assert b'rel="next"' in resp.data
+
+
+def test_feed_refresh_is_incremental(app, req_ctx, gh_blogger, commit_post, monkeypatch):
+    import feeds
+    app.config['FEED_MAX_ENTRIES'] = 5
+    posts = [commit_post(gh_blogger, f'post {n}\n\nbody {n}') for n in range(6)]
+    assert [e['id'] for e in gh_blogger.feed.entries] == [p.id for p in posts[:0:-1]]
+
+    serialized = []
+    serialize_entry = feeds.serialize_entry
+    monkeypatch.setattr(feeds, 'serialize_entry',
+        lambda post, blogger: serialized.append(post.id) or serialize_entry(post, blogger))
+
+    newest = commit_post(gh_blogger, 'newest\n\npost')
+    assert serialized == [newest.id]
+    assert gh_blogger.feed.entries[0]['id'] == newest.id
+    assert len(gh_blogger.feed.entries) == 5
+
+    # removing one pulls the next older post back into the feed
+    db.session.delete(newest)
+    db.session.flush()
+    feeds.refresh(gh_blogger)
+    assert serialized == [newest.id, posts[1].id]
+    assert [e['id'] for e in gh_blogger.feed.entries] == [p.id for p in posts[:0:-1]]
+
+
+def test_feed_head_follows_max_entries(app, req_ctx, gh_blogger, commit_post):
+    import feeds
+    app.config['FEED_MAX_ENTRIES'] = 5
+    for n in range(8):
+        commit_post(gh_blogger, f'post {n}\n\nbody {n}')
+    entries, _, older = feeds.get_head(gh_blogger)
+    assert len(entries) == 5 and older is not None
+
+    app.config['FEED_MAX_ENTRIES'] = 3
+    entries, _, older = feeds.get_head(gh_blogger)
+    assert len(entries) == 3
+    app.config['FEED_MAX_ENTRIES'] = 10
+    entries, _, older = feeds.get_head(gh_blogger)
+    assert len(entries) == 8 and older is None
+
+
+def test_feed_head_built_concurrently(app, req_ctx, gh_blogger, commit_post):
+    import feeds
+    from models import BlogFeed
+    commit_post(gh_blogger, 'hello\n\nworld')
+    feeds.invalidate(gh_blogger)
+    db.session.commit()
+    assert gh_blogger.feed is None
+    # another request's first poll gets there first
+    with db.engine.begin() as conn:
+        conn.execute(BlogFeed.__table__.insert().values(
+            blogger_id=gh_blogger.id, entries=[{'id': 0, 'xml': 'theirs'}]))
+    entries, _, _ = feeds.get_head(gh_blogger)
+    assert entries == ['theirs']
+
+
+def test_blog_post_short_sha(client, gh_blogger, commit_post, blog_host):
+    host = blog_host(gh_blogger)
+    post = commit_post(gh_blogger, 'a post\n\nwith a body')
+    full_path = f'/{post.repo.full_name}/{post.hex}'
+
+    resp = client.get(f'/{post.repo.full_name}/{post.hex[:7]}', base_url=host)
+    assert resp.status_code == 301
+    assert resp.headers['Location'].endswith(full_path)
+
+    resp = client.get(f'/{post.repo.full_name}/{post.hex[:7].upper()}', base_url=host)
+    assert resp.status_code == 301
+
+    assert client.get(f'/{post.repo.full_name}/{post.hex[:6]}', base_url=host).status_code == 404
+    assert client.get(f'/not/{post.repo.full_name}/{post.hex}', base_url=host).status_code == 404
+
+
+def test_short_sha_must_be_unambiguous(app_ctx, gh_blogger, commit_post):
+    from models import CommitPost
+    a = commit_post(gh_blogger, 'a', hex='abcdef0' + '1' * 33)
+    b = commit_post(gh_blogger, 'b', hex='abcdef0' + '2' * 33)
+    assert CommitPost.from_permalink(gh_blogger, a.repo.full_name, 'abcdef0') is None
+    assert CommitPost.from_permalink(gh_blogger, a.repo.full_name, 'abcdef01') is a
+    assert CommitPost.from_permalink(gh_blogger, b.repo.full_name, b.hex) is b
+
+
+def test_blog_list_streamed(app, client, gh_blogger, many_posts, blog_host):
+    app.config.update(STREAM_BLOG_LIST=True, STREAM_POSTS_PER_PAGE=20, STREAM_BATCH_SIZE=7)
+    resp = client.get('/', base_url=blog_host(gh_blogger), buffered=False)
+    assert resp.is_streamed
+    first_chunk = next(iter(resp.response))
+    assert b'<!doctype html>' in first_chunk
+
+    resp = client.get('/', base_url=blog_host(gh_blogger))
+    assert resp.data.count(b'<article>') == 20
+    older = make_cursor(many_posts[-20])
+    assert f'before={older}'.encode() in resp.data
+
+    resp = client.get('/', base_url=blog_host(gh_blogger), query_string={'before': older})
+    assert resp.data.count(b'<article>') == 20
+    assert b'newer' in resp.data
+
+
+def queued_rerenders():
+    return sorted(t.details['post_id'] for t in Task.query.filter(Task.task == 'rerender'))
+
+
+@pytest.mark.parametrize('stream', (False, True))
+def test_read_repair(app, client, gh_blogger, commit_post, blog_host, stream):
+    app.config['STREAM_BLOG_LIST'] = stream
+    host = blog_host(gh_blogger)
+    stale = [commit_post(gh_blogger, f'stale {n}\n\nold *render*') for n in range(2)]
+    commit_post(gh_blogger, 'current\n\nalready fine')
+    for post in stale:
+        post.markdown_renderer = '0.0.1'
+    db.session.commit()
+
+    client.get(f'{host}/{stale[0].repo.full_name}/{stale[0].hex}')
+    assert queued_rerenders() == [stale[0].id]
+    client.get(f'{host}/').get_data()
+    client.get(f'{host}/').get_data()
+    assert queued_rerenders() == sorted(post.id for post in stale)
+
+    for task in Task.query.filter(Task.task == 'rerender'):
+        tasks.rerender(task)
+    assert CommitPost.stale_renders().count() == 0
+
+
+def test_read_repair_keeps_pages_cheap(app, client, gh_blogger, commit_post, blog_host):
+    host = blog_host(gh_blogger)
+    for n in range(5):
+        post = commit_post(gh_blogger, f'stale {n}\n\nold *render*')
+        post.markdown_renderer = '0.0.1'
+    db.session.commit()
+
+    def query_count():
+        page_cache.invalidate(gh_blogger.username)
+        return int(client.get(f'{host}/').headers['X-Query-Count'])
+
+    app.config['READ_REPAIR'] = False
+    without_repair = query_count()
+    app.config['READ_REPAIR'] = True
+    query_count()  # queues the rerenders
+    assert len(queued_rerenders()) == 5
+    # already queued: just the lookup, no commit reloading every post
+    assert query_count() == without_repair + 1
+
+
+def test_read_repair_bodyless_post(app, client, gh_blogger, commit_post, blog_host):
+    host = blog_host(gh_blogger)
+    post = commit_post(gh_blogger, 'only a title')
+    post.markdown_renderer = '0.0.1'
+    db.session.commit()
+    client.get(f'{host}/')
+    task, = Task.query.filter(Task.task == 'rerender')
+    tasks.rerender(task)
+    assert not CommitPost.query.get(post.id).can_rerender()
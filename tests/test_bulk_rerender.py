@@ -0,0 +1,55 @@
+import bulk_rerender
+import render_message
+from models import CommitPost
+
+
+def test_rerender_stale(app, tmp_path, gh_blogger, commit_post, blog_host, make_stale):
+    blog_host(gh_blogger)
+    stale = commit_post(gh_blogger, 'stale\n\nneeds *rerendering*')
+    empty = commit_post(gh_blogger, 'no body')
+    current = commit_post(gh_blogger, 'current\n\nalready rendered')
+    make_stale(stale, empty)
+    checkpoint = tmp_path / 'checkpoint'
+
+    assert bulk_rerender.rerender_stale(processes=1, checkpoint=str(checkpoint)) == 2
+    assert not checkpoint.exists()
+    assert CommitPost.stale_renders().count() == 0
+    assert '<em>rerendering</em>' in CommitPost.query.get(stale.id).markdown_body
+    assert CommitPost.query.get(empty.id).markdown_body == ''
+    assert CommitPost.query.get(current.id).markdown_renderer == render_message.__version__
+
+
+def test_rerender_stays_within_render_limits(app, tmp_path, gh_blogger, commit_post, blog_host, make_stale):
+    blog_host(gh_blogger)
+    too_big = commit_post(gh_blogger, 'title\n\na body well over the limit')
+    fits = commit_post(gh_blogger, 'title\n\nshort')
+    make_stale(too_big, fits)
+    app.config['RENDER_MAX_BYTES'] = 16
+
+    bulk_rerender.rerender_stale(processes=1, checkpoint=str(tmp_path / 'checkpoint'))
+    too_big, fits = CommitPost.query.get(too_big.id), CommitPost.query.get(fits.id)
+    assert too_big.render_fallback == 'too large'
+    assert too_big.markdown_body.startswith('<pre class="render-fallback">')
+    assert fits.render_fallback is None
+    assert not too_big.can_rerender()
+
+
+def test_rerender_resumes_from_checkpoint(app, tmp_path, gh_blogger, commit_post, blog_host, make_stale):
+    blog_host(gh_blogger)
+    done = commit_post(gh_blogger, 'before\n\nthe checkpoint')
+    todo = commit_post(gh_blogger, 'after\n\nthe checkpoint')
+    make_stale(done, todo)
+    checkpoint = tmp_path / 'checkpoint'
+    bulk_rerender.write_checkpoint(str(checkpoint), done.id)
+
+    assert bulk_rerender.rerender_stale(processes=1, checkpoint=str(checkpoint)) == 1
+    assert CommitPost.query.get(done.id).markdown_renderer == '0.0.1'
+    assert CommitPost.query.get(todo.id).markdown_renderer == render_message.__version__
+
+
+def test_checkpoint_from_other_renderer_is_ignored(app, tmp_path, monkeypatch):
+    checkpoint = tmp_path / 'checkpoint'
+    bulk_rerender.write_checkpoint(str(checkpoint), 42)
+    assert bulk_rerender.read_checkpoint(str(checkpoint)) == 42
+    monkeypatch.setattr(render_message, '__version__', 'next')
+    assert bulk_rerender.read_checkpoint(str(checkpoint)) == 0
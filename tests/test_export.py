@@ -0,0 +1,70 @@
+import export
+from models import db
+from pagecache import page_cache
+
+
+def test_export(app, tmp_path, gh_blogger, blogger, commit_post, blog_host):
+    blog_host(gh_blogger)
+    post = commit_post(gh_blogger, 'exported\n\nfor nginx')
+    commit_post(blogger('other', 'Other'), 'also\n\nexported')
+
+    manifest = export.export(str(tmp_path))
+    assert set(manifest) == {'uniphil', 'other'}
+    assert b'exported' in (tmp_path / 'uniphil' / 'index.html').read_bytes()
+    assert b'<entry' in (tmp_path / 'uniphil' / 'feed.xml').read_bytes()
+    post_page = tmp_path / 'uniphil' / post.repo.full_name / post.hex / 'index.html'
+    assert b'for nginx' in post_page.read_bytes()
+
+
+def test_export_incremental(app, tmp_path, monkeypatch, gh_blogger, blogger, commit_post, blog_host):
+    blog_host(gh_blogger)
+    changing = commit_post(gh_blogger, 'one\n\nwill change')
+    unposted = commit_post(gh_blogger, 'two\n\nwill be unposted')
+    commit_post(gh_blogger, 'three\n\nstays the same')
+    commit_post(blogger('other', 'Other'), 'untouched\n\nblog')
+    export.export(str(tmp_path))
+
+    written = []
+    write_atomic = export.write_atomic
+    monkeypatch.setattr(export, 'write_atomic',
+        lambda path, data: written.append(path) or write_atomic(path, data))
+
+    changing.markdown_body = '<p>changed!</p>'
+    db.session.delete(unposted)
+    gh_blogger.touch_blog()
+    db.session.commit()
+    page_cache.invalidate(gh_blogger.username)
+    export.export(str(tmp_path), incremental=True)
+
+    blog_dir = tmp_path / 'uniphil'
+    changed_page = blog_dir / changing.repo.full_name / changing.hex / 'index.html'
+    assert sorted(written) == sorted([
+        str(blog_dir / 'index.html'),
+        str(blog_dir / 'feed.xml'),
+        str(changed_page),
+        str(tmp_path / export.MANIFEST),
+    ])
+    assert b'changed!' in changed_page.read_bytes()
+    assert not (blog_dir / unposted.repo.full_name / unposted.hex).exists()
+
+
+def test_export_incremental_after_deploy(app, tmp_path, monkeypatch, gh_blogger, commit_post, blog_host):
+    blog_host(gh_blogger)
+    post = commit_post(gh_blogger, 'exported\n\nbefore the deploy')
+    export.export(str(tmp_path))
+
+    written = []
+    write_atomic = export.write_atomic
+    monkeypatch.setattr(export, 'write_atomic',
+        lambda path, data: written.append(path) or write_atomic(path, data))
+    monkeypatch.setitem(app.extensions, 'app_version', 'new templates')
+    manifest = export.export(str(tmp_path), incremental=True)
+
+    blog_dir = tmp_path / 'uniphil'
+    assert sorted(written) == sorted([
+        str(blog_dir / 'index.html'),
+        str(blog_dir / 'feed.xml'),
+        str(blog_dir / post.repo.full_name / post.hex / 'index.html'),
+        str(tmp_path / export.MANIFEST),
+    ])
+    assert manifest['uniphil']['app_version'] == 'new templates'
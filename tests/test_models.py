@@ -19,3 +19,47 @@ def test_blogger_model(app_ctx):
 def test_db_did_reset(app_ctx):
     bloggers = Blogger.query.all()
     assert len(bloggers) == 0
+
+
+def test_blogger_from_subdomain_ignores_case(app_ctx):
+    db.session.add(Blogger(username='MixedCase'))
+    db.session.commit()
+
+    assert Blogger.from_subdomain('mixedcase').username == 'MixedCase'
+    assert Blogger.from_subdomain('MIXEDCASE').username == 'MixedCase'
+
+
+def test_blogger_from_subdomain_forgets_deleted(app_ctx):
+    gone = Blogger(username='gone')
+    db.session.add(gone)
+    db.session.commit()
+    assert Blogger.from_subdomain('gone') is gone
+
+    db.session.delete(gone)
+    db.session.commit()
+    assert Blogger.from_subdomain('gone') is None
+
+    db.session.add(Blogger(username='Gone'))
+    db.session.commit()
+    assert Blogger.from_subdomain('gone').username == 'Gone'
+
+
+def test_commit_post_splits_message_on_write(app_ctx, gh_blogger, commit_post):
+    post = commit_post(gh_blogger, 'the title\nand the\nbody')
+    assert (post.title, post.body) == ('the title', 'and the\nbody')
+    assert post.get_title() == 'the title'
+    assert post.get_body() == 'and the\nbody'
+
+    post.message = 'just a title'
+    assert (post.title, post.body) == ('just a title', '')
+
+
+def test_commit_post_records_render_fallback(app_ctx, gh_blogger, commit_post):
+    import render_message
+    render_message.render_guard.configure(max_bytes=16, timeout=0)
+    rendered = commit_post(gh_blogger, 'title\n\nshort')
+    too_big = commit_post(gh_blogger, 'title\n\na body over sixteen bytes')
+    assert rendered.render_fallback is None
+    assert too_big.render_fallback == 'too large'
+    assert too_big.markdown_body.startswith('<pre class="render-fallback">')
+    assert not too_big.can_rerender()
@@ -1,3 +1,7 @@
+import pytest
+import render_message
+from benchmarks import corpus
+from benchmarks.sanitise import single_pass, two_pass
 from render_message import render_github
 
 
@@ -105,3 +109,143 @@ const ANSWER = 42;
 ''', 'uniphil', 'commit--blog', 'asdf')
     expected = '<div class="codehilite"><pre><span></span><code>const ANSWER = 42;\n</code></pre></div>'
     assert out == expected
+
+
+def test_render_github_reuses_markdown_per_commit():
+    first = render_github('see #1 and ![img](a.png)', 'uniphil', 'commit--blog', 'aaa')
+    second = render_github('see #1 and ![img](a.png)', 'someone', 'else', 'bbb')
+    assert 'uniphil/commit--blog/issues/1' in first
+    assert 'uniphil/commit--blog/aaa/a.png' in first
+    assert 'someone/else/issues/1' in second
+    assert 'someone/else/bbb/a.png' in second
+
+
+def test_render_github_resets_between_renders():
+    with_note = render_github('a claim[^1]\n\n[^1]: citation', 'uniphil', 'commit--blog', 'asdf')
+    assert 'citation' in with_note
+    without = render_github('no notes here[^1]', 'uniphil', 'commit--blog', 'asdf')
+    assert 'citation' not in without
+
+
+def test_render_cache_skips_repeat_renders(monkeypatch):
+    monkeypatch.setattr(render_message, 'render_cache', render_message.RenderCache())
+    renders = []
+    uncached = render_message.render_github_uncached
+    monkeypatch.setattr(render_message, 'render_github_uncached',
+        lambda *args: renders.append(args) or uncached(*args))
+
+    first = render_github('*cached*', 'uniphil', 'commit--blog', 'asdf')
+    assert render_github('*cached*', 'uniphil', 'commit--blog', 'asdf') == first
+    assert len(renders) == 1
+    render_github('*cached*', 'uniphil', 'commit--blog', 'other-sha')
+    assert len(renders) == 2
+    monkeypatch.setattr(render_message, '__version__', 'next')
+    render_github('*cached*', 'uniphil', 'commit--blog', 'asdf')
+    assert len(renders) == 3
+
+
+def test_render_cache_on_disk(tmp_path):
+    cache = render_message.RenderCache(directory=str(tmp_path))
+    key = cache.key('text', 'uniphil', 'commit--blog', 'asdf')
+    assert cache.get(key) is None
+    cache.set(key, '<p>text</p>')
+
+    another_process = render_message.RenderCache(directory=str(tmp_path))
+    assert another_process.get(key) == '<p>text</p>'
+
+
+def test_highlighting_reuses_lexers_and_formatters(monkeypatch):
+    pygments_cache = render_message.PygmentsCache()
+    monkeypatch.setattr(render_message.codehilite, 'get_lexer_by_name', pygments_cache.get_lexer_by_name)
+    monkeypatch.setattr(render_message.codehilite, 'get_formatter_by_name', pygments_cache.get_formatter_by_name)
+    monkeypatch.setattr(render_message.codehilite, 'highlight', pygments_cache.highlight)
+
+    message = '```python\nx = 1\n```\n\n```\nplain\n```\n\n```nonsense\nhuh\n```'
+    first = render_message.render_github_uncached(message, 'uniphil', 'commit--blog', 'asdf')
+    lexers, formatters = len(pygments_cache.lexers), len(pygments_cache.formatters)
+    second = render_message.render_github_uncached(message, 'uniphil', 'commit--blog', 'asdf')
+    assert first == second
+    assert '<span class="n">x</span>' in first
+    assert len(pygments_cache.lexers) == lexers
+    assert len(pygments_cache.formatters) == formatters == 1
+    assert pygments_cache.timings['Python'][0] == 2
+    assert pygments_cache.timings['Text only'][0] == 4
+
+
+def test_pygments_cache_is_bounded():
+    pygments_cache = render_message.PygmentsCache(max_lexers=2, max_formatters=2)
+    for n in range(10):
+        with pytest.raises(ValueError):
+            pygments_cache.get_lexer_by_name(f'nonsense-{n}')
+        pygments_cache.get_formatter_by_name('html', hl_lines=[n])
+    assert len(pygments_cache.lexers) == 2
+    assert len(pygments_cache.formatters) == 2
+
+
+def test_regression_linkify_urls_with_entities():
+    out = render_github('see https://example.com/?a=1&b=2 &copy; "q"', 'uniphil', 'commit--blog', 'asdf')
+    expected = '<p>see <a href="https://example.com/?a=1&amp;b=2">https://example.com/?a=1&amp;b=2</a> © "q"</p>'
+    assert out == expected
+
+
+ENTITIES = (
+    'wait&hellip; &mdash; &rarr; &ldquo;q&rdquo; &trade; &copy &amp; &#8212; &#x2014;'
+    ' &nosuch; &notit; &notin; AT&T &',
+    '<a href="https://e.com/?x=1&hellip;y" title="a&mdash;b&copy=c">t&hellip;</a>',
+    '[x](https://e.com/?a=1&b=2&mdash;c "t&ldquo;x")',
+)
+
+
+@pytest.mark.parametrize('kind', ('entities', *corpus.KINDS))
+def test_single_pass_cleaner_matches_two_pass(kind):
+    messages = ENTITIES if kind == 'entities' else corpus.generate(per_kind=10)[kind]
+    for message in messages:
+        with render_message.markdown_pool.markdown('uniphil', 'commit--blog', 'asdf') as md:
+            html = md.convert(message)
+        assert single_pass(html) == two_pass(html)
+
+
+def slow_render(text, user, repo, sha):
+    import time
+    time.sleep(5)
+
+
+def test_render_guard_renders_in_worker():
+    guard = render_message.RenderGuard(timeout=5, workers=1)
+    try:
+        html, fallback = guard.render('*worked*', 'uniphil', 'commit--blog', 'guarded')
+    finally:
+        guard.close()
+    assert html == '<p><em>worked</em></p>'
+    assert fallback is None
+
+
+def test_render_guard_size_limit():
+    guard = render_message.RenderGuard(max_bytes=10, timeout=0)
+    html, fallback = guard.render('<b>way</b> too long', 'uniphil', 'commit--blog', 'asdf')
+    assert html == '<pre class="render-fallback">&lt;b&gt;way&lt;/b&gt; too long</pre>'
+    assert fallback == 'too large'
+
+
+def test_render_guard_time_limit(monkeypatch):
+    monkeypatch.setattr(render_message, 'render_github_uncached', slow_render)
+    guard = render_message.RenderGuard(timeout=0.2, workers=1)
+    html, fallback = guard.render('slow', 'uniphil', 'commit--blog', 'asdf')
+    assert html == '<pre class="render-fallback">slow</pre>'
+    assert fallback == 'timed out'
+    assert guard.pool is None
+
+
+def test_render_guard_timeout_leaves_replacement_pool():
+    guard = render_message.RenderGuard(timeout=5, workers=1)
+    try:
+        stuck = guard.get_pool()
+        guard.discard(stuck)  # one request's render timed out...
+        replacement = guard.get_pool()
+        assert replacement is not stuck
+        guard.discard(stuck)  # ...and so did another's on the same old pool
+        assert guard.pool is replacement
+        html, fallback = guard.render('*still*', 'uniphil', 'commit--blog', 'replaced')
+        assert fallback is None
+    finally:
+        guard.close()
@@ -0,0 +1,299 @@
+import datetime
+import multiprocessing
+import pytest
+import threading
+import tasks
+import time
+from commitblog import create_app
+from contextlib import contextmanager
+from models import db, Blogger, CommitPost, Task
+from wakeup import task_wakeup
+
+
+def test_async_render(app, gh_blogger, commit_post, blog_host, client):
+    app.config['RENDER_ASYNC'] = True
+    host = blog_host(gh_blogger)
+    post = commit_post(gh_blogger, 'rendered\n\n*later* <b>on</b>')
+    assert post.render_fallback == 'pending'
+    assert post.can_rerender()
+    page = client.get(f'{host}/{post.repo.full_name}/{post.hex}')
+    assert b'*later* &lt;b&gt;on&lt;/b&gt;' in page.data
+    etag = page.headers['ETag']
+
+    task, = Task.query.filter(Task.task == 'render')
+    assert task.creator is gh_blogger
+    tasks.render(task)
+
+    post = CommitPost.query.get(post.id)
+    assert post.render_fallback is None
+    assert post.markdown_body == '<p><em>later</em> <b>on</b></p>'
+    page = client.get(f'{host}/{post.repo.full_name}/{post.hex}',
+                      headers={'If-None-Match': etag})
+    assert page.status_code == 200
+    assert b'<em>later</em>' in page.data
+
+
+def test_async_render_skips_unposted(app, gh_blogger, commit_post):
+    app.config['RENDER_ASYNC'] = True
+    post = commit_post(gh_blogger, 'gone\n\nbefore rendering')
+    task, = Task.query.filter(Task.task == 'render')
+    db.session.delete(post)
+    db.session.commit()
+    tasks.render(task)
+
+
+@pytest.fixture
+def socket_wakeup(app, tmp_path):
+    app.config.update(TASK_WAKEUP='socket', TASK_WAKEUP_DIR=str(tmp_path / 'wakeup'))
+    task_wakeup.init_app(app)
+
+
+def queue_email(blogger):
+    db.session.add(Task(task='email', details={}, creator=blogger))
+    db.session.commit()
+
+
+def test_queueing_a_task_wakes_listeners(app_ctx, socket_wakeup, gh_blogger):
+    with task_wakeup.listen() as wait, task_wakeup.listen() as other_wait:
+        assert not wait(0)
+        queue_email(gh_blogger)
+        assert wait(5)
+        assert other_wait(5)
+        assert not wait(0)
+
+        gh_blogger.name = 'no tasks here'
+        db.session.commit()
+        assert not wait(0)
+
+
+def test_rolled_back_tasks_dont_wake(app_ctx, socket_wakeup, gh_blogger):
+    with task_wakeup.listen() as wait:
+        db.session.add(Task(task='email', details={}, creator=gh_blogger))
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        assert not wait(0)
+
+
+def claim_until_empty(database_url):
+    app = create_app({'TESTING': True, 'DATABASE_URL': database_url, 'TASK_WAKEUP': 'poll'})
+    claimed = []
+    with app.app_context():
+        while task := tasks.take_task(max_retry=20):
+            claimed.append(task.id)
+    return claimed
+
+
+def test_take_task_claims_each_task_once(tmp_path):
+    database_url = f'sqlite:///{tmp_path}/queue.db'
+    app = create_app({'TESTING': True, 'DATABASE_URL': database_url, 'TASK_WAKEUP': 'poll'})
+    with app.app_context():
+        db.create_all()
+        creator = Blogger(username='worker')
+        db.session.add_all(Task(task='email', details={'n': n}, creator=creator)
+                           for n in range(300))
+        db.session.commit()
+        task_ids = {task.id for task in Task.query}
+
+    with multiprocessing.Pool(8) as pool:
+        claims = pool.map(claim_until_empty, [database_url] * 8)
+
+    claimed = [task_id for worker_claims in claims for task_id in worker_claims]
+    assert sorted(claimed) == sorted(task_ids)
+    assert sum(1 for worker_claims in claims if worker_claims) > 1
+    with app.app_context():
+        assert tasks.take_task() is None
+
+
+def test_runner_limits_each_task_type(tmp_path, monkeypatch):
+    database_url = f'sqlite:///{tmp_path}/queue.db'
+    app = create_app({'TESTING': True, 'DATABASE_URL': database_url,
+                      'TASK_WAKEUP': 'socket', 'TASK_WAKEUP_DIR': str(tmp_path / 'wakeup')})
+    release = threading.Event()
+    slow_started, quick_done = [], []
+
+    def slow(task):
+        slow_started.append(task.id)
+        release.wait(10)
+
+    def quick(task):
+        quick_done.append(task.id)
+
+    monkeypatch.setattr(tasks, '_task_handlers', {'slow': slow, 'quick': quick})
+    with app.app_context():
+        db.create_all()
+        creator = Blogger(username='worker')
+        db.session.add_all([Task(task='slow', details={}, creator=creator),
+                            Task(task='slow', details={}, creator=creator)])
+        db.session.commit()
+
+    runner = tasks.Runner(app, limits={'slow': 1, 'quick': 2}, poll_interval=30)
+    thread = threading.Thread(target=runner.run)
+    thread.start()
+    try:
+        with app.app_context():
+            creator = Blogger.query.one()
+            db.session.add_all(Task(task='quick', details={}, creator=creator)
+                               for _ in range(3))
+            db.session.commit()  # wakes the runner
+        for _ in range(100):
+            if len(quick_done) == 3:
+                break
+            time.sleep(0.05)
+        assert len(quick_done) == 3
+        assert len(slow_started) == 1  # the other slow one waits its turn
+        runner.drain()
+    finally:
+        release.set()
+        thread.join(10)
+    assert not thread.is_alive()
+
+    with app.app_context():
+        assert Task.query.filter(Task.completed.isnot(None)).count() == 4
+        assert Task.query.filter(Task.started.is_(None)).count() == 1
+
+
+def test_failed_tasks_retry_with_backoff_then_fail(app_ctx, gh_blogger, monkeypatch):
+    failures = []
+
+    def flaky(task):
+        failures.append(task.attempts)
+        raise RuntimeError(f'nope #{len(failures)}')
+
+    monkeypatch.setattr(tasks, '_task_handlers', {'flaky': flaky})
+    monkeypatch.setattr(tasks.limits, 'TASK_MAX_ATTEMPTS', {'flaky': 3})
+    db.session.add(Task(task='flaky', details={}, creator=gh_blogger))
+    db.session.commit()
+
+    for attempt in (1, 2):
+        task = tasks.take_task()
+        tasks.run_task(task)
+        assert task.started is None and task.failed is None
+        assert task.attempts == attempt
+        assert task.run_after > datetime.datetime.utcnow()
+        assert tasks.take_task() is None  # not due yet
+        task.run_after = datetime.datetime.utcnow()
+        db.session.commit()
+
+    task = tasks.take_task()
+    tasks.run_task(task)
+    assert failures == [1, 2, 3]
+    assert task.failed is not None
+    assert task.get_last_error() == 'RuntimeError: nope #3'
+    assert [u.state for u in task.updates] == ['retrying', 'retrying', 'failed']
+    task.run_after = None
+    db.session.commit()
+    assert tasks.take_task() is None  # failed tasks stay put
+
+    task.requeue()
+    db.session.commit()
+    assert tasks.take_task() is task
+
+
+def test_retry_delay_grows():
+    for attempt in range(1, 6):
+        delay = tasks.retry_delay(attempt).total_seconds()
+        full = min(30 * 2 ** (attempt - 1), 3600)
+        assert full / 2 <= delay <= full
+
+
+def test_completed_tasks_record_an_update(app_ctx, gh_blogger, monkeypatch):
+    monkeypatch.setattr(tasks, '_task_handlers', {'fine': lambda task: None})
+    db.session.add(Task(task='fine', details={}, creator=gh_blogger))
+    db.session.commit()
+    task = tasks.take_task()
+    tasks.run_task(task)
+    assert task.completed is not None
+    assert [(u.state, u.details) for u in task.updates] == [('completed', {'attempt': 1})]
+
+
+def test_take_task_goes_by_priority_then_age(app_ctx, gh_blogger):
+    normal = Task.enqueue('email', {}, creator=gh_blogger)
+    background = Task.enqueue('email', {}, priority=Task.BACKGROUND, creator=gh_blogger)
+    urgent = Task.enqueue('email', {}, priority=Task.URGENT, creator=gh_blogger)
+    later_normal = Task.enqueue('email', {}, creator=gh_blogger)
+    db.session.commit()
+    claimed = [tasks.take_task() for _ in range(5)]
+    assert claimed == [urgent, normal, later_normal, background, None]
+
+
+def test_delayed_tasks_wait_their_turn(app_ctx, gh_blogger):
+    delayed = Task.enqueue('email', {}, priority=Task.URGENT, creator=gh_blogger,
+                           delay=datetime.timedelta(minutes=5))
+    db.session.commit()
+    assert tasks.take_task() is None
+    assert 290 < tasks.next_due_in() <= 300
+    assert tasks.next_due_in(['clone']) is None
+
+    delayed.run_after = datetime.datetime.utcnow()
+    db.session.commit()
+    assert tasks.next_due_in() is None
+    assert tasks.take_task() is delayed
+
+
+
+def runner_app(tmp_path):
+    app = create_app({'TESTING': True, 'DATABASE_URL': f'sqlite:///{tmp_path}/queue.db',
+                      'TASK_WAKEUP': 'socket', 'TASK_WAKEUP_DIR': str(tmp_path / 'wakeup')})
+    with app.app_context():
+        db.create_all()
+        db.session.add(Blogger(username='worker'))
+        db.session.commit()
+    return app
+
+
+@contextmanager
+def running(runner):
+    thread = threading.Thread(target=runner.run)
+    thread.start()
+    try:
+        yield
+    finally:
+        runner.drain()
+        thread.join(10)
+    assert not thread.is_alive()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_runner_wakes_for_delayed_tasks(tmp_path, monkeypatch):
+    app = runner_app(tmp_path)
+    done = []
+    monkeypatch.setattr(tasks, '_task_handlers', {'fine': lambda task: done.append(task.id)})
+    runner = tasks.Runner(app, poll_interval=30)
+    with running(runner), app.app_context():
+        Task.enqueue('fine', {}, creator=Blogger.query.one(),
+                     delay=datetime.timedelta(seconds=0.5))
+        db.session.commit()
+        assert not done
+        assert wait_for(lambda: done)
+
+
+def test_runner_survives_errors(tmp_path, monkeypatch):
+    from sqlalchemy.exc import OperationalError
+    app = runner_app(tmp_path)
+    done, failures = [], ['listen', 'take']
+    monkeypatch.setattr(tasks, '_task_handlers', {'fine': lambda task: done.append(task.id)})
+
+    def fail_once(name, real):
+        def maybe_fail(*args):
+            if name in failures:
+                failures.remove(name)
+                raise OperationalError('select', {}, Exception('database is locked'))
+            return real(*args)
+        return maybe_fail
+
+    monkeypatch.setattr(tasks, '_poll_timeout', fail_once('listen', tasks._poll_timeout))
+    runner = tasks.Runner(app, poll_interval=30)
+    monkeypatch.setattr(runner, 'take_tasks', fail_once('take', runner.take_tasks))
+    with running(runner), app.app_context():
+        assert wait_for(lambda: not failures)
+        time.sleep(1.5)  # the listener is back
+        Task.enqueue('fine', {}, creator=Blogger.query.one())
+        db.session.commit()
+        assert wait_for(lambda: done)
@@ -0,0 +1,35 @@
+"""Helpers shared by the app, its tasks and management commands"""
+
+from importlib import import_module
+import os
+import tempfile
+
+
+def write_atomic(path, data):
+    """write-then-rename, so readers never see a half-written file"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def get_backend_class(name, backends):
+    """one of `backends` by name, or any class as 'some.module:SomeClass'"""
+    if name in backends:
+        return backends[name]
+    module_name, class_name = name.split(':', 1)
+    return getattr(import_module(module_name), class_name)
+
+
+worker_app = None
+
+
+def init_worker():
+    """process pool initializer: each worker gets its own app"""
+    global worker_app
+    from commitblog import create_app
+    worker_app = create_app()
@@ -0,0 +1,168 @@
+"""Wake idle task runners when tasks are queued
+
+Backends, by TASK_WAKEUP: `auto` (default), `postgres` (LISTEN/NOTIFY),
+`socket` (same host only), `poll`, or 'module:Class'.
+"""
+
+from contextlib import contextmanager
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import text
+from uuid import uuid4
+import logging
+import os
+import select
+import socket
+import time
+import util
+from models import db, Task
+
+
+class PollBackend:
+    def __init__(self, app):
+        pass
+
+    def notify(self):
+        pass
+
+    @contextmanager
+    def listen(self):
+        def wait(timeout):
+            time.sleep(timeout)
+            return False
+        yield wait
+
+
+class SocketBackend:
+    def __init__(self, app):
+        self.directory = app.config['TASK_WAKEUP_DIR']
+
+    def notify(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return  # nobody has listened yet
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            for name in names:
+                try:
+                    sock.sendto(b'!', os.path.join(self.directory, name))
+                except ConnectionRefusedError:
+                    # left behind by a listener that didn't exit cleanly
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass  # its buffer is full: it has wakeups waiting already
+
+    @contextmanager
+    def listen(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{uuid4().hex}.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.setblocking(False)
+
+        def wait(timeout):
+            readable, _, _ = select.select([sock], [], [], timeout)
+            try:
+                while sock.recv(64):
+                    pass  # one wakeup is as good as many
+            except BlockingIOError:
+                pass
+            return bool(readable)
+
+        try:
+            yield wait
+        finally:
+            sock.close()
+            os.remove(path)
+
+
+class PostgresBackend:
+    CHANNEL = 'commitblog_tasks'
+
+    def __init__(self, app):
+        pass
+
+    def notify(self):
+        with db.engine.connect() as conn:
+            conn.execute(text(f'NOTIFY {self.CHANNEL}')
+                         .execution_options(autocommit=True))
+
+    @contextmanager
+    def listen(self):
+        conn = db.engine.raw_connection()
+        dbapi_conn = conn.connection
+        dbapi_conn.autocommit = True
+        with dbapi_conn.cursor() as cursor:
+            cursor.execute(f'LISTEN {self.CHANNEL}')
+
+        def wait(timeout):
+            readable, _, _ = select.select([dbapi_conn], [], [], timeout)
+            dbapi_conn.poll()
+            woken = bool(dbapi_conn.notifies)
+            dbapi_conn.notifies.clear()
+            return woken
+
+        try:
+            yield wait
+        finally:
+            with dbapi_conn.cursor() as cursor:
+                cursor.execute(f'UNLISTEN {self.CHANNEL}')
+            dbapi_conn.autocommit = False
+            conn.close()
+
+
+backends = {
+    'poll': PollBackend,
+    'socket': SocketBackend,
+    'postgres': PostgresBackend,
+}
+
+
+def get_backend_class(name, app):
+    if name == 'auto':
+        uri = app.config['SQLALCHEMY_DATABASE_URI']
+        name = 'postgres' if uri.startswith(('postgres:', 'postgresql')) else 'socket'
+    return util.get_backend_class(name, backends)
+
+
+class TaskWakeup:
+
+    def init_app(self, app):
+        backend_class = get_backend_class(app.config['TASK_WAKEUP'], app)
+        app.extensions['task_wakeup'] = backend_class(app)
+
+    @property
+    def backend(self):
+        return current_app.extensions['task_wakeup']
+
+    def notify(self):
+        try:
+            self.backend.notify()
+        except Exception as e:
+            # the task is queued either way; runners will find it on a poll
+            logging.warning(f'could not wake task runners: {e}')
+
+    def listen(self):
+        return self.backend.listen()
+
+
+task_wakeup = TaskWakeup()
+
+
+@event.listens_for(Session, 'after_flush')
+def note_new_tasks(session, flush_context):
+    if any(isinstance(obj, Task) for obj in session.new):
+        session.info['tasks_added'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def wake_for_new_tasks(session):
+    if session.info.pop('tasks_added', False) and has_app_context():
+        task_wakeup.notify()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_new_tasks(session):
+    session.info.pop('tasks_added', None)